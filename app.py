@@ -1,17 +1,26 @@
 import streamlit as st
 import json
 import os
-import glob
 import uuid
 import socket
 import base64
 import mimetypes
 import re
+import hashlib
+import tempfile
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import database
 import rag_utils
 from openai import OpenAI
 
+# Optional fast JSON for chat sessions and notebooks
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 # Optional Lottie animation (Task 1)
 try:
     from streamlit_lottie import st_lottie
@@ -71,29 +80,34 @@ _LOTTIE_LOGIN = {
 
 DATA_DIR = "data"
 SYSTEM_SETTINGS_FILE = os.path.join(DATA_DIR, "system", "settings.json")
+NOTEBOOK_PAGE_SIZE = 20
+PRACTICE_PAGE_SIZE = 20
+CHAT_RENDER_WINDOW = 40  # most recent messages drawn per chat rerun
 
+@st.cache_resource(show_spinner=False)
 def get_local_ip():
+    """Resolved once per process, on first use rather than at import.
+    SERVER_IP, when set, skips the socket probe entirely."""
+    if os.environ.get("SERVER_IP"): return os.environ["SERVER_IP"]
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.connect(("8.8.8.8", 80))
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); s.settimeout(0.5)
+        s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]; s.close(); return ip
     except Exception: return "127.0.0.1"
 
-SERVER_IP = get_local_ip()
-DEFAULT_OLLAMA_URL = f"http://{SERVER_IP}:11434/v1"
-DEFAULT_API_URL = f"http://{SERVER_IP}:3001/api/v1"
+def default_ollama_url(): return f"http://{get_local_ip()}:11434/v1"
+def default_api_url(): return f"http://{get_local_ip()}:3001/api/v1"
 
 # ---------------------------------------------------------------------------
 # System settings
 # ---------------------------------------------------------------------------
 
 def load_system_settings():
-    if os.path.exists(SYSTEM_SETTINGS_FILE):
-        try:
-            with open(SYSTEM_SETTINGS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return {}
+    try:
+        with open(SYSTEM_SETTINGS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
 
 def save_system_settings(settings):
     os.makedirs(os.path.dirname(SYSTEM_SETTINGS_FILE), exist_ok=True)
@@ -114,21 +128,38 @@ def _clean_base_url(url):
         url = url[:-len("/models")]
     return url
 
-def call_model_api(model, messages, image_b64=None):
-    """Non-streaming call. Supports optional image (Task 6)."""
-    client = OpenAI(api_key=model.get("api_key") or "not-required", base_url=_clean_base_url(model["api_url"]))
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _model_client(api_key, api_url):
+    """One client (and HTTP connection pool) per endpoint and key, kept
+    across calls and reruns so turns reuse open connections."""
+    return OpenAI(api_key=api_key or "not-required", base_url=_clean_base_url(api_url))
+
+
+def _build_messages(model, messages, image_b64=None):
+    """System prompt layers + history, with the image on the last user turn."""
     system_parts = []
     if model.get("system_prompt"): system_parts.append(model["system_prompt"])
     if model.get("override_prompt"): system_parts.append(model["override_prompt"])
     full_msgs = []
     if system_parts: full_msgs.append({"role": "system", "content": "\n\n".join(system_parts)})
-    full_msgs.extend([{"role": m["role"], "content": m["content"]} for m in messages])
-    # Attach image to last user message if provided
+    # Text turns ({role, content} only) are passed through without copying;
+    # only dicts carrying extra keys such as image_path are slimmed down.
+    full_msgs.extend(m if len(m) == 2 else {"role": m["role"], "content": m["content"]}
+                     for m in messages)
+    # Attach image to last user message if provided (as a new dict, so the
+    # caller's history is never mutated)
     if image_b64 and full_msgs and full_msgs[-1]["role"] == "user":
-        full_msgs[-1]["content"] = [
+        full_msgs[-1] = {"role": "user", "content": [
             {"type": "text", "text": full_msgs[-1]["content"]},
             {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
-        ]
+        ]}
+    return full_msgs
+
+
+def call_model_api(model, messages, image_b64=None):
+    """Non-streaming call. Supports optional image (Task 6)."""
+    client = _model_client(model.get("api_key"), model["api_url"])
+    full_msgs = _build_messages(model, messages, image_b64)
     model_name = model.get("model_name") or "gpt-3.5-turbo"
     try:
         resp = client.chat.completions.create(model=model_name, messages=full_msgs)
@@ -149,18 +180,8 @@ def call_model_api(model, messages, image_b64=None):
 
 def _stream_generator(model, messages, image_b64=None):
     """Generator yielding text chunks for st.write_stream (Task 8)."""
-    client = OpenAI(api_key=model.get("api_key") or "not-required", base_url=_clean_base_url(model["api_url"]))
-    system_parts = []
-    if model.get("system_prompt"): system_parts.append(model["system_prompt"])
-    if model.get("override_prompt"): system_parts.append(model["override_prompt"])
-    full_msgs = []
-    if system_parts: full_msgs.append({"role": "system", "content": "\n\n".join(system_parts)})
-    full_msgs.extend([{"role": m["role"], "content": m["content"]} for m in messages])
-    if image_b64 and full_msgs and full_msgs[-1]["role"] == "user":
-        full_msgs[-1]["content"] = [
-            {"type": "text", "text": full_msgs[-1]["content"]},
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
-        ]
+    client = _model_client(model.get("api_key"), model["api_url"])
+    full_msgs = _build_messages(model, messages, image_b64)
     try:
         stream = client.chat.completions.create(
             model=model.get("model_name") or "gpt-3.5-turbo",
@@ -192,6 +213,25 @@ def call_model_api_single(model, prompt):
     return call_model_api(model, [{"role": "user", "content": prompt}])
 
 
+def _test_model_connection(api_key, api_url, model_name):
+    """List models, falling back to a 1-token chat for servers without /models."""
+    with st.spinner("Testing…"):
+        client = _model_client(api_key, api_url)
+        try:
+            client.models.list()
+            st.toast("✅ Connection successful!", icon="✅")
+        except Exception:
+            try:
+                client.chat.completions.create(
+                    model=model_name or "gpt-3.5-turbo",
+                    messages=[{"role": "user", "content": "ping"}],
+                    max_tokens=1
+                )
+                st.toast("✅ Connection ok (chat)!", icon="✅")
+            except Exception as e2:
+                st.toast(f"❌ Failed: {e2}", icon="❌")
+
+
 
 # ---------------------------------------------------------------------------
 # Student data helpers
@@ -199,36 +239,116 @@ def call_model_api_single(model, prompt):
 
 def get_user_dir(username): return os.path.join(DATA_DIR, username)
 
+def _dumps(data):
+    """Compact UTF-8 JSON bytes, via orjson when installed."""
+    if HAS_ORJSON: return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _loads(raw): return orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+
+# A session is a JSON snapshot ({id}.json) plus an append-only tail of the
+# messages added since that snapshot ({id}.jsonl). Each chat turn only appends
+# to the tail; flush_session folds it back into the snapshot.
+
+def _session_paths(username, session_id):
+    history_dir = os.path.join(get_user_dir(username), "history")
+    return (os.path.join(history_dir, f"{session_id}.json"),
+            os.path.join(history_dir, f"{session_id}.jsonl"))
+
+# runner.py keeps a sidebar index of these files (history/.index; older
+# versions used _index.json). Any change made here drops it, and the runner
+# rebuilds it from the session files.
+_HISTORY_INDEX_NAMES = (".index", "_index.json")
+
+def _invalidate_history_index(username):
+    history_dir = os.path.join(get_user_dir(username), "history")
+    for name in _HISTORY_INDEX_NAMES:
+        try: os.remove(os.path.join(history_dir, name))
+        except FileNotFoundError: pass
+
 def save_session(username, session_id, messages):
+    """Rewrite the full snapshot (and drop the now-redundant tail)."""
     if not messages: return
     title = "New Chat"
     for m in messages:
         if m["role"] == "user":
             title = m["content"][:30] + ("..." if len(m["content"]) > 30 else "")
             break
-    history_dir = os.path.join(get_user_dir(username), "history")
-    os.makedirs(history_dir, exist_ok=True)
+    json_path, log_path = _session_paths(username, session_id)
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
     to_save = [{k: v for k, v in m.items() if k != "image_data"} for m in messages]
-    with open(os.path.join(history_dir, f"{session_id}.json"), "w", encoding="utf-8") as f:
-        json.dump({"id": session_id, "title": title, "updated_at": datetime.now().isoformat(),
-                   "messages": to_save}, f, ensure_ascii=False, indent=2)
+    # Compact, and handed to the file in one write() call
+    payload = _dumps({"id": session_id, "title": title, "updated_at": datetime.now().isoformat(),
+                      "messages": to_save})
+    with open(json_path, "wb") as f: f.write(payload)
+    try: os.remove(log_path)
+    except FileNotFoundError: pass
+    _invalidate_history_index(username)
+
+def append_session(username, session_id, messages, n_new=2):
+    """Persist only the last `n_new` messages. The first turn of a new session
+    writes the snapshot so it shows up in the history list with its title."""
+    json_path, log_path = _session_paths(username, session_id)
+    if not os.path.exists(json_path):
+        save_session(username, session_id, messages); return
+    payload = b"".join(_dumps({k: v for k, v in m.items() if k != "image_data"}) + b"\n"
+                       for m in messages[-n_new:])
+    with open(log_path, "ab") as f: f.write(payload)
+    _invalidate_history_index(username)
+
+def flush_session(username, session_id):
+    """Fold the appended tail back into the canonical JSON snapshot."""
+    json_path, log_path = _session_paths(username, session_id)
+    if not os.path.exists(log_path): return
+    msgs, _ = load_session(username, session_id)
+    save_session(username, session_id, msgs)
 
 def load_session(username, session_id):
-    path = os.path.join(get_user_dir(username), "history", f"{session_id}.json")
+    json_path, log_path = _session_paths(username, session_id)
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            d = json.load(f); return d.get("messages", []), d.get("title", "New Chat")
+        with open(json_path, "rb") as f:
+            d = _loads(f.read())
     except Exception: return [], "New Chat"
+    msgs = d.get("messages", [])
+    try:
+        with open(log_path, "rb") as f:
+            for line in f:
+                try: msgs.append(_loads(line))
+                except ValueError: pass  # torn final line from an interrupted append
+    except FileNotFoundError: pass
+    return msgs, d.get("title", "New Chat")
 
 def delete_session(username, session_id):
-    path = os.path.join(get_user_dir(username), "history", f"{session_id}.json")
-    if os.path.exists(path): os.remove(path)
-
-def save_image(username, image_bytes):
+    for path in _session_paths(username, session_id):
+        try: os.remove(path)
+        except FileNotFoundError: pass
+    _invalidate_history_index(username)
+
+def save_image(username, file_like):
+    """Stream an uploaded file to disk, hashing it on the way. Files are named
+    by content, so sending the same image again reuses the stored copy."""
     images_dir = os.path.join(get_user_dir(username), "images")
     os.makedirs(images_dir, exist_ok=True)
-    filename = f"{uuid.uuid4()}.png"
-    with open(os.path.join(images_dir, filename), "wb") as f: f.write(image_bytes)
+    ext = os.path.splitext(getattr(file_like, "name", "") or "")[1].lower() or ".png"
+    h = hashlib.sha256()
+    file_like.seek(0)
+    with tempfile.NamedTemporaryFile(dir=images_dir, suffix=".part", delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: file_like.read(1024 * 1024), b""):
+                h.update(chunk); tmp.write(chunk)
+        except BaseException:
+            # Don't leave a partial copy behind; nothing was named after it yet
+            tmp.close(); os.unlink(tmp.name)
+            raise
+    filename = h.hexdigest() + ext
+    final = os.path.join(images_dir, filename)
+    try:
+        if os.path.exists(final): os.unlink(tmp.name)
+        else: os.replace(tmp.name, final)
+    except OSError:
+        try: os.unlink(tmp.name)
+        except FileNotFoundError: pass
+        raise
     return filename
 
 def get_image_path(username, filename):
@@ -237,24 +357,28 @@ def get_image_path(username, filename):
 def get_notebook_path(username): return os.path.join(get_user_dir(username), "notebook.json")
 
 def load_notebook(username):
-    path = get_notebook_path(username)
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f: return json.load(f)
-        except Exception: pass
-    return []
+    """Entries newest-first. runner.py appends to the same file, so its order
+    on disk is not relied on."""
+    try:
+        with open(get_notebook_path(username), "rb") as f: nb = _loads(f.read())
+        nb.sort(key=lambda e: e.get("timestamp", ""), reverse=True)
+        return nb
+    except Exception: return []
 
 def save_notebook(username, data):
     path = get_notebook_path(username)
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False, indent=2)
+    payload = _dumps(data)
+    with open(path, "wb") as f: f.write(payload)
 
 def add_to_notebook(username, question, answer, summary=None):
     nb = load_notebook(username)
-    nb.append({"id": str(uuid.uuid4()), "timestamp": datetime.now().isoformat(),
-               "title": (summary or question)[:50], "question": question,
-               "answer": answer, "summary": summary})
+    entry_id = str(uuid.uuid4())
+    nb.insert(0, {"id": entry_id, "timestamp": datetime.now().isoformat(),
+                  "title": (summary or question)[:50], "question": question,
+                  "answer": answer, "summary": summary})
     save_notebook(username, nb)
+    return entry_id
 
 def delete_notebook_entry(username, entry_id):
     save_notebook(username, [e for e in load_notebook(username) if e["id"] != entry_id])
@@ -265,6 +389,72 @@ def update_notebook_entry_title(username, entry_id, new_title):
         if e["id"] == entry_id: e["title"] = new_title
     save_notebook(username, nb)
 
+def update_notebook_entry_summary(username, entry_id, summary):
+    """Fill in a summary that arrived after the entry was added."""
+    nb = load_notebook(username)
+    for e in nb:
+        if e["id"] == entry_id:
+            # Entries start out titled by their question; use the summary
+            # instead unless the student has renamed it meanwhile.
+            if e["title"] == e["question"][:50]: e["title"] = summary[:50]
+            e["summary"] = summary
+    save_notebook(username, nb)
+
+# ---------------------------------------------------------------------------
+# Cached lookups
+# ---------------------------------------------------------------------------
+# Streamlit reruns the whole script on every interaction; these wrappers keep
+# the hot read paths off SQLite / disk. The TTL bounds staleness across
+# processes, and the mutations in this file clear them explicitly.
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_models():
+    return database.get_models()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_allowed_models(user_id):
+    return database.get_allowed_models_for_student(user_id)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _notebook_version(username, mtime):
+    """load_notebook, keyed on the file's mtime so runner.py's writes show too."""
+    return load_notebook(username)
+
+def cached_notebook(username):
+    try: mtime = os.stat(get_notebook_path(username)).st_mtime_ns
+    except FileNotFoundError: mtime = None
+    return _notebook_version(username, mtime)
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def cached_session_title(fpath, mtime):
+    """Sidebar title of a saved chat; mtime only keys the cache."""
+    try:
+        with open(fpath, "rb") as f: return _loads(f.read()).get("title", "Untitled")
+    except Exception: return "Corrupted"
+
+def clear_model_caches():
+    """Call after any write that changes models or who may use them."""
+    cached_models.clear()
+    cached_allowed_models.clear()
+
+@st.cache_resource
+def background_executor():
+    """Process-wide pool for slow model calls that shouldn't block a rerun."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def indexing_jobs():
+    """doc_id -> Future of documents being indexed by this process."""
+    return {}
+
+def _index_document(doc_id, file_path, file_type):
+    """Runs on background_executor: build (or reuse) the page index and record it."""
+    try:
+        index = rag_utils.build_or_load_page_index(file_path, file_type)
+        database.update_document_index(doc_id, rag_utils.save_index(doc_id, index), "indexed")
+    except Exception:
+        database.update_document_index(doc_id, None, "failed")
+
 # ---------------------------------------------------------------------------
 # CSS + startup
 # ---------------------------------------------------------------------------
@@ -814,7 +1004,7 @@ def _admin_models(current_admin):
             with c1:
                 m_name = st.text_input("Display Name *")
                 m_model_name = st.text_input("Model Name (e.g. llama3, gpt-4o)")
-                m_url = st.text_input("API Base URL", value=DEFAULT_OLLAMA_URL)
+                m_url = st.text_input("API Base URL", value=default_ollama_url())
             with c2:
                 m_key = st.text_input("API Key (if required)", type="password")
                 m_prompt = st.text_area("System Prompt (optional)")
@@ -828,7 +1018,7 @@ def _admin_models(current_admin):
                         is_active=1 if m_active else 0,
                         managed_by="admin"
                     )
-                    if ok: st.success("Model added!"); st.rerun()
+                    if ok: clear_model_caches(); st.success("Model added!"); st.rerun()
                     else: st.error("Model name already exists.")
                 else:
                     st.warning("Display name and API URL required.")
@@ -857,31 +1047,16 @@ def _admin_models(current_admin):
             test_col, save_col, del_col = st.columns([1.5, 1.5, 1])
             with test_col:
                 if st.button("🔌 Test Connection", key=f"amtest_{m['id']}"):
-                    with st.spinner("Testing…"):
-                        try:
-                            _c = OpenAI(api_key=n_key or "not-required", base_url=_clean_base_url(n_url))
-                            _c.models.list()
-                            st.toast("✅ Connection successful!", icon="✅")
-                        except Exception:
-                            try:
-                                _c2 = OpenAI(api_key=n_key or "not-required", base_url=_clean_base_url(n_url))
-                                _c2.chat.completions.create(
-                                    model=n_mn or "gpt-3.5-turbo",
-                                    messages=[{"role": "user", "content": "ping"}],
-                                    max_tokens=1
-                                )
-                                st.toast("✅ Connection ok (chat)!", icon="✅")
-                            except Exception as e2:
-                                st.toast(f"❌ Failed: {e2}", icon="❌")
+                    _test_model_connection(n_key, n_url, n_mn)
             with save_col:
                 if st.button("💾 Save", key=f"amsave_{m['id']}", type="primary"):
                     database.update_model(m["id"], n_name, n_mn, n_url,
                                           n_key or None, n_prompt or None,
                                           is_active=1 if n_active else 0)
-                    st.success("Saved"); st.rerun()
+                    clear_model_caches(); st.success("Saved"); st.rerun()
             with del_col:
                 if st.button("🗑️ Delete", key=f"amdel_{m['id']}"):
-                    database.delete_model(m["id"]); st.rerun()
+                    database.delete_model(m["id"]); clear_model_caches(); st.rerun()
 
 
 # ── Admin: Class Management ─────────────────────────────────────────────────
@@ -930,7 +1105,7 @@ def _admin_classes():
                     database.update_class(cls["id"], name=n_name, subject=n_subj); st.rerun()
             with col2:
                 if st.button("Delete Class", key=f"acldel_{cls['id']}"):
-                    database.delete_class(cls["id"]); st.rerun()
+                    database.delete_class(cls["id"]); clear_model_caches(); st.rerun()
 
 
 # ── Admin: Teacher-Student Relationships ────────────────────────────────────
@@ -959,7 +1134,7 @@ def _admin_teacher_students():
                         if checked != (s["id"] in enrolled_ids):
                             if checked: database.add_student_to_class(cls["id"], s["id"])
                             else: database.remove_student_from_class(cls["id"], s["id"])
-                            st.rerun()
+                            clear_model_caches(); st.rerun()
 
 
 # ── Admin: System Settings ──────────────────────────────────────────────────
@@ -1236,7 +1411,7 @@ def _teacher_analytics(user):
                         who = "You" if log["role"] == "user" else "AI"
                         st.markdown(f"**{who}:** {log['content']}")
                     if sess_logs and st.button("Analyse with AI", key=f"ana_sess_{sid}"):
-                        models = database.get_models()
+                        models = cached_models()
                         if not models:
                             st.warning("No models configured.")
                         else:
@@ -1270,7 +1445,7 @@ def _teacher_classes(user):
 
     classes = database.get_classes_for_teacher(teacher_id)
     all_students = database.get_all_students()
-    all_models = database.get_models()
+    all_models = cached_models()
 
     if not classes:
         st.info("No classes yet. Click **＋ New Class** to get started."); return
@@ -1330,7 +1505,7 @@ def _teacher_classes(user):
             if checked != (s["id"] in enrolled_ids):
                 if checked: database.add_student_to_class(cls["id"], s["id"])
                 else: database.remove_student_from_class(cls["id"], s["id"])
-                st.rerun()
+                clear_model_caches(); st.rerun()
 
     st.markdown("**Model Access for this Class**")
     cls_access = database.get_class_model_access(cls["id"])
@@ -1348,6 +1523,7 @@ def _teacher_classes(user):
         with sv_col:
             if st.button("Set", key=f"tmaset_{cls['id']}_{m['id']}"):
                 database.set_class_model_access(cls["id"], m["id"], allowed, override or None)
+                clear_model_caches()
                 st.success("Saved")
         # Task 5: 3-layer prompt preview
         if allowed:
@@ -1362,7 +1538,7 @@ def _teacher_classes(user):
 
     st.divider()
     if st.button("🗑️ Delete Class", key=f"tcldel_{cls['id']}"):
-        database.delete_class(cls["id"])
+        database.delete_class(cls["id"]); clear_model_caches()
         st.session_state["_managing_class"] = None
         st.rerun()
 
@@ -1371,8 +1547,7 @@ def _teacher_classes(user):
 
 def _teacher_models(user):
     st.markdown("## Models")
-    all_docs = database.get_documents()
-    indexed_docs = [d for d in all_docs if d["index_status"] == "indexed"]
+    indexed_docs = database.get_indexed_documents()
     doc_map = {d["id"]: d["name"] for d in indexed_docs}
     all_students = database.get_all_students()
 
@@ -1403,10 +1578,11 @@ def _teacher_models(user):
                         st.info("No indexed documents yet. Index files in the Knowledge Base tab.")
 
                 with tab_access:
+                    changed = []
                     for s in all_students:
                         access_map = database.get_student_model_access_map(s["id"])
                         cur = access_map.get(m["id"], {})
-                        a_col, op_col, sv_col = st.columns([1, 3, 1])
+                        a_col, op_col = st.columns([1, 4])
                         with a_col:
                             allowed = st.checkbox(s["username"], value=bool(cur.get("allowed", 0)),
                                                   key=f"pmsma_{m['id']}_{s['id']}")
@@ -1417,10 +1593,12 @@ def _teacher_models(user):
                                 placeholder="Student-level override prompt",
                                 label_visibility="collapsed"
                             )
-                        with sv_col:
-                            if st.button("Set", key=f"pmsmaset_{m['id']}_{s['id']}"):
-                                database.set_student_model_access(s["id"], m["id"], allowed, override or None)
-                                st.success("Set")
+                        if allowed != bool(cur.get("allowed", 0)) or (override or None) != cur.get("override_prompt"):
+                            changed.append((s["id"], m["id"], allowed, override or None))
+                    if all_students and st.button("Save Access", key=f"pmsmasave_{m['id']}", type="primary"):
+                        database.set_student_model_access_bulk(changed)
+                        clear_model_caches()
+                        st.success(f"Saved {len(changed)} change(s)")
 
     st.divider()
 
@@ -1436,7 +1614,7 @@ def _teacher_models(user):
             with c1:
                 m_name = st.text_input("Display Name *")
                 m_model_name = st.text_input("Model Name (e.g. llama3)")
-                m_url = st.text_input("API Base URL", value=DEFAULT_OLLAMA_URL)
+                m_url = st.text_input("API Base URL", value=default_ollama_url())
             with c2:
                 m_key = st.text_input("API Key (if required)", type="password")
                 m_prompt = st.text_area("System Prompt (optional)")
@@ -1447,7 +1625,7 @@ def _teacher_models(user):
                         m_key or None, m_prompt or None,
                         created_by=user["id"], is_active=1, managed_by="teacher"
                     )
-                    if ok: st.success("Model added!"); st.rerun()
+                    if ok: clear_model_caches(); st.success("Model added!"); st.rerun()
                     else: st.error("Model name already exists.")
                 else: st.warning("Display name and API URL required.")
 
@@ -1472,31 +1650,15 @@ def _teacher_models(user):
                 test_col, save_col, del_col = st.columns([1.5, 1.5, 1])
                 with test_col:
                     if st.button("🔌 Test Connection", key=f"test_{m['id']}"):
-                        with st.spinner("Testing…"):
-                            try:
-                                _c = OpenAI(api_key=n_key or "not-required", base_url=_clean_base_url(n_url))
-                                _c.models.list()
-                                st.toast("✅ Connection successful!", icon="✅")
-                            except Exception as e:
-                                err = str(e)
-                                try:
-                                    _c2 = OpenAI(api_key=n_key or "not-required", base_url=_clean_base_url(n_url))
-                                    _c2.chat.completions.create(
-                                        model=n_mn or "gpt-3.5-turbo",
-                                        messages=[{"role":"user","content":"ping"}],
-                                        max_tokens=1
-                                    )
-                                    st.toast("✅ Connection successful (chat ok)!", icon="✅")
-                                except Exception as e2:
-                                    st.toast(f"❌ Connection failed: {e2}", icon="❌")
+                        _test_model_connection(n_key, n_url, n_mn)
                 with save_col:
                     if st.button("💾 Save", key=f"msave_{m['id']}", type="primary"):
                         database.update_model(m["id"], n_name, n_mn, n_url,
                                               n_key or None, n_prompt or None)
-                        st.success("Saved"); st.rerun()
+                        clear_model_caches(); st.success("Saved"); st.rerun()
                 with del_col:
                     if st.button("🗑️ Delete", key=f"mdel_{m['id']}"):
-                        database.delete_model(m["id"]); st.rerun()
+                        database.delete_model(m["id"]); clear_model_caches(); st.rerun()
 
             with tab_rag:
                 if indexed_docs:
@@ -1515,10 +1677,11 @@ def _teacher_models(user):
                     st.info("No indexed documents yet. Index files in the Knowledge Base tab.")
 
             with tab_access:
+                changed = []
                 for s in all_students:
                     access_map = database.get_student_model_access_map(s["id"])
                     cur = access_map.get(m["id"], {})
-                    a_col, op_col, sv_col = st.columns([1, 3, 1])
+                    a_col, op_col = st.columns([1, 4])
                     with a_col:
                         allowed = st.checkbox(s["username"], value=bool(cur.get("allowed", 0)),
                                               key=f"sma_{m['id']}_{s['id']}")
@@ -1527,10 +1690,12 @@ def _teacher_models(user):
                                                  key=f"smop_{m['id']}_{s['id']}",
                                                  placeholder="Override prompt",
                                                  label_visibility="collapsed")
-                    with sv_col:
-                        if st.button("Set", key=f"smaset_{m['id']}_{s['id']}"):
-                            database.set_student_model_access(s["id"], m["id"], allowed, override or None)
-                            st.success("Set")
+                    if allowed != bool(cur.get("allowed", 0)) or (override or None) != cur.get("override_prompt"):
+                        changed.append((s["id"], m["id"], allowed, override or None))
+                if all_students and st.button("Save Access", key=f"smasave_{m['id']}", type="primary"):
+                    database.set_student_model_access_bulk(changed)
+                    clear_model_caches()
+                    st.success(f"Saved {len(changed)} change(s)")
 
 
 # ── Teacher: Knowledge Base ─────────────────────────────────────────────────
@@ -1605,26 +1770,21 @@ def _teacher_kb(user):
             with st.expander(f"{doc['name']}  {status_html}", expanded=False):
                 ic1, ic2, ic3 = st.columns([1.5, 2, 1])
                 with ic1:
-                    if doc["index_status"] != "indexed":
-                        if st.button("⚙️ Index", key=f"idx_{doc['id']}", type="primary"):
-                            if doc.get("file_path") and os.path.exists(doc["file_path"]):
-                                prog = st.progress(0, text="Extracting…")
-                                try:
-                                    prog.progress(30, text="Extracting pages…")
-                                    index = rag_utils.build_page_index(doc["file_path"], doc["file_type"])
-                                    prog.progress(70, text="Saving index…")
-                                    index_path = rag_utils.save_index(doc["id"], index)
-                                    database.update_document_index(doc["id"], index_path, "indexed")
-                                    prog.progress(100, text="Done!")
-                                    st.success("Indexed"); st.rerun()
-                                except Exception as e:
-                                    prog.empty()
-                                    st.error(f"Error: {e}")
-                                    database.update_document_index(doc["id"], None, "failed")
-                            else:
-                                st.error("File not found on disk.")
-                    else:
+                    job = indexing_jobs().get(doc["id"])
+                    if doc["index_status"] == "indexed":
                         st.success("✓ Indexed")
+                    elif job and not job.done():
+                        # Extraction and summaries run off the rerun thread.
+                        st.info("⏳ Indexing…")
+                        if st.button("↻ Refresh", key=f"idxr_{doc['id']}"): st.rerun()
+                    elif st.button("⚙️ Index", key=f"idx_{doc['id']}", type="primary"):
+                        if doc.get("file_path") and os.path.exists(doc["file_path"]):
+                            database.update_document_index(doc["id"], None, "indexing")
+                            indexing_jobs()[doc["id"]] = background_executor().submit(
+                                _index_document, doc["id"], doc["file_path"], doc["file_type"])
+                            st.rerun()
+                        else:
+                            st.error("File not found on disk.")
                 with ic2:
                     sel_folder = st.selectbox("Move to folder", list(folder_opts.keys()),
                                               key=f"movef_{doc['id']}")
@@ -1633,16 +1793,17 @@ def _teacher_kb(user):
                         st.rerun()
                 with ic3:
                     if st.button("🗑️ Delete", key=f"deldoc_{doc['id']}"):
-                        for p in [doc.get("file_path"), doc.get("index_path")]:
-                            if p and os.path.exists(p):
-                                try: os.remove(p)
-                                except Exception: pass
+                        if doc.get("file_path"):
+                            try: os.remove(doc["file_path"])
+                            except OSError: pass
+                        if doc.get("index_path"):
+                            rag_utils.delete_index(doc["index_path"])
                         database.delete_document(doc["id"]); st.rerun()
 
         # Question generation
         with st.expander("🧠 Generate Practice Questions", expanded=False):
-            all_indexed = [d for d in database.get_documents() if d["index_status"]=="indexed"]
-            all_models = database.get_models()
+            all_indexed = database.get_indexed_documents()
+            all_models = cached_models()
             all_students_l = database.get_all_students()
             if not all_indexed:
                 st.info("Index documents first.")
@@ -1668,9 +1829,8 @@ def _teacher_kb(user):
                                 f"Label each, include answer. Format cleanly.\\n\\nDocument:\\n{context}")
                         st.markdown(result)
                         aids = [s["id"] for s in all_students_l if s["username"] in q_stus] or [None]
-                        for aid in aids:
-                            database.save_generated_question(q_doc["id"], ", ".join(q_types),
-                                                             result, assigned_to=aid)
+                        database.save_generated_questions(
+                            [(q_doc["id"], ", ".join(q_types), result, None, None, aid) for aid in aids])
                         st.success("Saved.")
 
 
@@ -1685,9 +1845,162 @@ def _render_settings_inline(user):
 # STUDENT WORKSPACE
 # ===========================================================================
 
+def _flush_pending_session(username):
+    """Compact the current chat's appended tail before leaving it."""
+    if st.session_state.get("_pending_save") and st.session_state.get("session_id"):
+        flush_session(username, st.session_state.session_id)
+    st.session_state._pending_save = False
+
+
+def _collect_pending_summaries(username):
+    """Store notebook summaries whose background call has finished."""
+    pending = st.session_state.get("pending_summaries")
+    if not pending: return
+    for entry_id, fut in list(pending.items()):
+        if not fut.done(): continue
+        del pending[entry_id]
+        try: summary = fut.result()
+        except Exception: continue
+        if summary and not summary.startswith("[Model Error]"):
+            update_notebook_entry_summary(username, entry_id, summary)
+
+
+def _set_messages(msgs):
+    """Replace the open chat. api_messages mirrors messages as slim
+    {role, content} dicts so a turn doesn't rebuild the model payload."""
+    st.session_state.messages = msgs
+    st.session_state.api_messages = [{"role": m["role"], "content": m["content"]} for m in msgs]
+    st.session_state.chat_show_all = False
+
+
+@st.fragment
+def _student_chat(user, current_model):
+    """Chat tab. Runs as a fragment so a turn reruns only this area, not the
+    sidebar and the other tabs."""
+    username = user["username"]
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
+    if "messages" not in st.session_state:
+        _set_messages([])
+    elif len(st.session_state.get("api_messages", ())) != len(st.session_state.messages):
+        _set_messages(st.session_state.messages)
+
+    # Streamlit redraws every element on each rerun, so long chats only draw
+    # the most recent window unless the student asks for the rest.
+    history = st.session_state.messages
+    hidden = 0 if st.session_state.get("chat_show_all") else max(0, len(history) - CHAT_RENDER_WINDOW)
+    if hidden:
+        if st.button(f"Show {hidden} earlier messages", key="chat_show_all_btn"):
+            st.session_state.chat_show_all = True
+            st.rerun(scope="fragment")
+        history = history[hidden:]
+
+    # Saved images are never removed mid-session, so stat each one only once.
+    img_exists = st.session_state.setdefault("_img_exists", {})
+    for msg in history:
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
+            if "image_path" in msg:
+                img_p = get_image_path(username, msg["image_path"])
+                if img_p not in img_exists: img_exists[img_p] = os.path.exists(img_p)
+                if img_exists[img_p]: st.image(img_p, width=300)
+
+    uploaded_file = st.file_uploader("Attach image", type=["jpg","png","jpeg"],
+                                     label_visibility="collapsed", key="chat_upload")
+    user_input = st.chat_input("Ask your AI Tutor…")
+
+    if user_input:
+        # Convert uploaded image to base64 for multimodal support
+        img_b64 = None
+        if uploaded_file:
+            img_b64 = base64.b64encode(uploaded_file.getvalue()).decode("utf-8")
+
+        with st.chat_message("user"):
+            st.markdown(user_input)
+            if uploaded_file: st.image(uploaded_file, width=300)
+
+        msg_data = {"role": "user", "content": user_input}
+        if uploaded_file:
+            msg_data["image_path"] = save_image(username, uploaded_file)
+        st.session_state.messages.append(msg_data)
+        st.session_state.api_messages.append({"role": "user", "content": user_input})
+
+        # Log user message
+        database.log_message(user["id"], st.session_state.session_id,
+                              current_model["id"] if current_model else None,
+                              "user", user_input)
+
+        if current_model:
+            rag_inject = ""
+            rag_docs = database.get_rag_docs_for_model(current_model["id"])
+            index_paths = [d["index_path"] for d in rag_docs
+                           if d.get("index_path") and os.path.exists(d["index_path"])]
+            for snippet in rag_utils.retrieve_context_many(index_paths, user_input):
+                if snippet: rag_inject += snippet + "\\n\\n"
+            chat_msgs = st.session_state.api_messages
+            if rag_inject:
+                # Context is sent for this turn only, not kept in the history.
+                chat_msgs = chat_msgs[:-1] + [{"role": "user", "content": (
+                    f"[Relevant context:]\\n{rag_inject.strip()}\\n\\n"
+                    f"[Question:] {user_input}"
+                )}]
+            with st.chat_message("assistant"):
+                placeholder = st.empty()
+                think_status = st.empty()
+                full_text = ""
+                for chunk in _stream_generator(current_model, chat_msgs, image_b64=img_b64):
+                    full_text += chunk
+                    n_open = full_text.count("<think>")
+                    n_close = full_text.count("</think>")
+                    in_think = n_open > n_close
+                    if in_think:
+                        think_status.caption("💭 Thinking…")
+                    else:
+                        think_status.empty()
+                        visible = re.sub(r"<think>.*?</think>", "", full_text, flags=re.DOTALL)
+                        visible = re.sub(r"<think>.*", "", visible, flags=re.DOTALL).strip()
+                        if visible:
+                            placeholder.markdown(visible + "▌")
+                think_status.empty()
+                placeholder.empty()
+                _render_think(full_text)
+                response_text = re.sub(r"<think>.*?</think>", "", full_text, flags=re.DOTALL).strip()
+        else:
+            response_text = "[No model assigned. Ask your teacher to grant access.]"
+            with st.chat_message("assistant"): st.markdown(response_text)
+
+        st.session_state.messages.append({"role": "assistant", "content": response_text})
+        st.session_state.api_messages.append({"role": "assistant", "content": response_text})
+        append_session(username, st.session_state.session_id, st.session_state.messages)
+        st.session_state._pending_save = True
+
+        # Log assistant message
+        database.log_message(user["id"], st.session_state.session_id,
+                              current_model["id"] if current_model else None,
+                              "assistant", response_text)
+
+        st.session_state.last_qa = (user_input, response_text)
+        # The fragment has already drawn this turn; only a brand-new chat
+        # needs a full rerun so it shows up under Recent Chats.
+        if len(st.session_state.messages) == 2: st.rerun()
+
+    if "last_qa" in st.session_state and current_model:
+        q, a = st.session_state.last_qa
+        if st.button("📓 Add Last Q&A to Notebook"):
+            # Save now; the summary is generated in the background and filled
+            # in by _collect_pending_summaries on a later rerun.
+            entry_id = add_to_notebook(username, q, a)
+            st.session_state.setdefault("pending_summaries", {})[entry_id] = background_executor().submit(
+                call_model_api_single, current_model,
+                f"Summarise the key concept or mistake in 1-2 sentences.\\nQ: {q}\\nA: {a}")
+            st.success("Added to Notebook! The key-learning summary will follow shortly.")
+            del st.session_state.last_qa
+
+
 def render_student_workspace(user):
     username = user["username"]
-    allowed_models = database.get_allowed_models_for_student(user["id"])
+    _collect_pending_summaries(username)
+    allowed_models = cached_allowed_models(user["id"])
 
     with st.sidebar:
         _logo = database.get_system_image_path("logo")
@@ -1709,32 +2022,42 @@ def render_student_workspace(user):
             st.warning("No models assigned. Ask your teacher."); sel_mid = None
 
         if st.button("＋ New Chat", use_container_width=True, type="primary"):
-            st.session_state.messages = []
+            _flush_pending_session(username)
+            _set_messages([])
             st.session_state.session_id = str(uuid.uuid4()); st.rerun()
 
         st.markdown("**Recent Chats**")
         history_dir = os.path.join(get_user_dir(username), "history")
-        os.makedirs(history_dir, exist_ok=True)
-        files = sorted(glob.glob(os.path.join(history_dir, "*.json")),
-                       key=os.path.getmtime, reverse=True)
-        for fpath in files[:20]:
-            sid = os.path.basename(fpath).replace(".json", "")
-            try:
-                with open(fpath, "r", encoding="utf-8") as f: meta = json.load(f)
-                title = meta.get("title", "Untitled")
-            except Exception: title = "Corrupted"
+        # One directory read; DirEntry.stat() needs no extra path lookup.
+        # A chat's last activity is the newer of its snapshot and its
+        # appended .jsonl tail.
+        snapshots, active = {}, {}
+        try:
+            with os.scandir(history_dir) as it:
+                for e in it:
+                    sid, ext = os.path.splitext(e.name)
+                    if ext not in (".json", ".jsonl") or e.name in _HISTORY_INDEX_NAMES: continue
+                    mtime = e.stat().st_mtime
+                    active[sid] = max(mtime, active.get(sid, 0))
+                    if ext == ".json": snapshots[sid] = (e.path, mtime)
+        except FileNotFoundError: pass
+        recent = sorted(snapshots, key=active.__getitem__, reverse=True)
+        for sid in recent[:20]:
+            title = cached_session_title(*snapshots[sid])
             hc1, hc2 = st.columns([4, 1])
             with hc1:
                 btn_title = title if len(title) < 22 else title[:19] + "…"
                 if st.button(btn_title, key=f"open_{sid}", use_container_width=True, help=title):
+                    _flush_pending_session(username)
                     msgs, _ = load_session(username, sid)
-                    st.session_state.messages = msgs
+                    _set_messages(msgs)
                     st.session_state.session_id = sid; st.rerun()
             with hc2:
                 if st.button("✕", key=f"hdel_{sid}", help="Delete"):
                     delete_session(username, sid)
                     if st.session_state.get("session_id") == sid:
-                        st.session_state.messages = []
+                        st.session_state._pending_save = False
+                        _set_messages([])
                         st.session_state.session_id = str(uuid.uuid4())
                     st.rerun()
 
@@ -1742,6 +2065,7 @@ def render_student_workspace(user):
         if st.button("⚙️ Settings", use_container_width=True):
             dialog_settings()
         if st.button("Logout", use_container_width=True):
+            _flush_pending_session(username)
             st.session_state.user = None; st.rerun()
 
     # Determine current model
@@ -1754,119 +2078,32 @@ def render_student_workspace(user):
 
     # ── Chat Tab ──────────────────────────────────────────────────────────────
     with tab_chat:
-        if "session_id" not in st.session_state:
-            st.session_state.session_id = str(uuid.uuid4())
-        if "messages" not in st.session_state:
-            st.session_state.messages = []
-
-        for msg in st.session_state.messages:
-            with st.chat_message(msg["role"]):
-                st.markdown(msg["content"])
-                if "image_path" in msg:
-                    img_p = get_image_path(username, msg["image_path"])
-                    if os.path.exists(img_p): st.image(img_p, width=300)
-
-        uploaded_file = st.file_uploader("Attach image", type=["jpg","png","jpeg"],
-                                         label_visibility="collapsed", key="chat_upload")
-        user_input = st.chat_input("Ask your AI Tutor…")
-
-        if user_input:
-            # Convert uploaded image to base64 for multimodal support
-            img_b64 = None
-            if uploaded_file:
-                img_b64 = base64.b64encode(uploaded_file.getvalue()).decode("utf-8")
-
-            with st.chat_message("user"):
-                st.markdown(user_input)
-                if uploaded_file: st.image(uploaded_file, width=300)
-
-            msg_data = {"role": "user", "content": user_input}
-            if uploaded_file:
-                msg_data["image_path"] = save_image(username, uploaded_file.getvalue())
-            st.session_state.messages.append(msg_data)
-
-            # Log user message
-            database.log_message(user["id"], st.session_state.session_id,
-                                  current_model["id"] if current_model else None,
-                                  "user", user_input)
-
-            if current_model:
-                rag_inject = ""
-                rag_docs = database.get_rag_docs_for_model(current_model["id"])
-                for rdoc in rag_docs:
-                    if rdoc.get("index_path") and os.path.exists(rdoc["index_path"]):
-                        snippet = rag_utils.retrieve_context(rdoc["index_path"], user_input)
-                        if snippet: rag_inject += snippet + "\\n\\n"
-                chat_msgs = [{"role": m["role"], "content": m["content"]}
-                              for m in st.session_state.messages]
-                if rag_inject:
-                    chat_msgs[-1]["content"] = (
-                        f"[Relevant context:]\\n{rag_inject.strip()}\\n\\n"
-                        f"[Question:] {user_input}"
-                    )
-                with st.chat_message("assistant"):
-                    placeholder = st.empty()
-                    think_status = st.empty()
-                    full_text = ""
-                    for chunk in _stream_generator(current_model, chat_msgs, image_b64=img_b64):
-                        full_text += chunk
-                        n_open = full_text.count("<think>")
-                        n_close = full_text.count("</think>")
-                        in_think = n_open > n_close
-                        if in_think:
-                            think_status.caption("💭 Thinking…")
-                        else:
-                            think_status.empty()
-                            visible = re.sub(r"<think>.*?</think>", "", full_text, flags=re.DOTALL)
-                            visible = re.sub(r"<think>.*", "", visible, flags=re.DOTALL).strip()
-                            if visible:
-                                placeholder.markdown(visible + "▌")
-                    think_status.empty()
-                    placeholder.empty()
-                    _render_think(full_text)
-                    response_text = re.sub(r"<think>.*?</think>", "", full_text, flags=re.DOTALL).strip()
-            else:
-                response_text = "[No model assigned. Ask your teacher to grant access.]"
-                with st.chat_message("assistant"): st.markdown(response_text)
-
-            st.session_state.messages.append({"role": "assistant", "content": response_text})
-            save_session(username, st.session_state.session_id, st.session_state.messages)
-
-            # Log assistant message
-            database.log_message(user["id"], st.session_state.session_id,
-                                  current_model["id"] if current_model else None,
-                                  "assistant", response_text)
-
-            st.session_state.last_qa = (user_input, response_text)
-            st.rerun()
-
-        if "last_qa" in st.session_state and current_model:
-            q, a = st.session_state.last_qa
-            if st.button("📓 Add Last Q&A to Notebook"):
-                with st.spinner("Summarising…"):
-                    summary = call_model_api_single(current_model,
-                        f"Summarise the key concept or mistake in 1-2 sentences.\\nQ: {q}\\nA: {a}")
-                    add_to_notebook(username, q, a, summary)
-                st.success("Added to Notebook!")
-                del st.session_state.last_qa
+        _student_chat(user, current_model)
 
     # ── Practice Tab ──────────────────────────────────────────────────────────
     with tab_practice:
         st.markdown("## Practice Questions")
-        assigned_qs = database.get_questions_for_student(user["id"])
-        if assigned_qs:
+        n_assigned = database.count_questions_for_student(user["id"])
+        if n_assigned:
             st.markdown("### Assigned by Teacher")
+            n_pages = -(-n_assigned // PRACTICE_PAGE_SIZE)
+            page = 1
+            if n_pages > 1:
+                if st.session_state.get("pq_page", 1) > n_pages: st.session_state.pq_page = n_pages
+                page = st.number_input("Page", min_value=1, max_value=n_pages, step=1, key="pq_page")
+            assigned_qs = database.get_questions_for_student(
+                user["id"], include_options=False,
+                limit=PRACTICE_PAGE_SIZE, offset=(page - 1) * PRACTICE_PAGE_SIZE)
             for q in assigned_qs:
                 with st.expander(f"[{q['question_type']}] {q.get('doc_name','')}"):
                     st.markdown(q["question"])
             st.divider()
 
         st.markdown("### Generate from My Notebook")
-        notebook = load_notebook(username)
+        notebook = cached_notebook(username)
         if not notebook:
             st.info("Your notebook is empty. Add entries from the Chat tab first.")
         else:
-            notebook.sort(key=lambda x: x["timestamp"], reverse=True)
             opts = {e["id"]: f"{e['title']} ({e['timestamp'][:10]})" for e in notebook}
             sel_ids = st.multiselect("Select entries:", list(opts.keys()),
                                      format_func=lambda x: opts[x])
@@ -1890,12 +2127,17 @@ def render_student_workspace(user):
     # ── Notebook Tab ──────────────────────────────────────────────────────────
     with tab_notebook:
         st.markdown("## My Notebook")
-        notebook = load_notebook(username)
+        notebook = cached_notebook(username)
         if not notebook:
             st.info("No entries yet. Add from Chat tab.")
         else:
-            notebook.sort(key=lambda x: x["timestamp"], reverse=True)
-            for entry in notebook:
+            n_pages = -(-len(notebook) // NOTEBOOK_PAGE_SIZE)
+            page = 1
+            if n_pages > 1:
+                if st.session_state.get("nb_page", 1) > n_pages: st.session_state.nb_page = n_pages
+                page = st.number_input("Page", min_value=1, max_value=n_pages, step=1, key="nb_page")
+            start = (page - 1) * NOTEBOOK_PAGE_SIZE
+            for entry in notebook[start:start + NOTEBOOK_PAGE_SIZE]:
                 with st.expander(f"{entry['title']}  —  {entry['timestamp'][:16]}"):
                     new_title = st.text_input("Title", value=entry["title"],
                                               key=f"nbt_{entry['id']}")
@@ -1908,6 +2150,8 @@ def render_student_workspace(user):
                         st.markdown("**Answer**"); st.info(entry["answer"])
                     if entry.get("summary"):
                         st.markdown("**Key Learning**"); st.warning(entry["summary"])
+                    elif entry["id"] in st.session_state.get("pending_summaries", {}):
+                        st.caption("⏳ Summarising…")
                     if st.button("🗑️ Delete", key=f"nbdel_{entry['id']}"):
                         delete_notebook_entry(username, entry["id"]); st.rerun()
         if st.button("Refresh"): st.rerun()
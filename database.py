@@ -1,12 +1,20 @@
 import sqlite3
 import hashlib
+import hmac
 import os
+import queue
 import json
 import csv
 import io
 import re
 import secrets
+import threading
+import time
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 # Optional bcrypt (Task 9)
 try:
@@ -22,10 +30,175 @@ try:
 except ImportError:
     HAS_FERNET = False
 
+# Optional orjson for generated_questions.options; stdlib json otherwise.
+try:
+    import orjson as _orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def _json_dumps(obj):
+    if HAS_ORJSON:
+        return _orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def _json_loads(text):
+    # orjson.JSONDecodeError subclasses ValueError, like json's.
+    if HAS_ORJSON:
+        return _orjson.loads(text)
+    return json.loads(text)
+
+
+_now_second = (None, "")
+
+
+def _now():
+    """Timestamp for created_at/updated_at columns (ISO-8601 TEXT)."""
+    # Kept as text: analytics group by DATE(created_at), the UI slices the
+    # string for display, and ISO strings already sort chronologically.
+    # Local time like datetime.now(), but the date/time part is formatted
+    # once per second and only the microseconds are filled in per call.
+    global _now_second
+    t = time.time()
+    sec = int(t)
+    cached_sec, prefix = _now_second
+    if sec != cached_sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec))
+        _now_second = (sec, prefix)
+    return "%s.%06d" % (prefix, (t - sec) * 1e6)
+
+
 # Task 11: configurable DB via environment variable
 _db_url = os.environ.get("DATABASE_URL", "dse_ai.db")
 DB_FILE = _db_url[10:] if _db_url.startswith("sqlite:///") else _db_url
 
+# Open connections are pooled per DB_FILE and handed out by get_conn().
+# Streamlit runs every rerun on a fresh thread, so per-thread connections
+# would be reopened on each rerun; a shared LIFO pool keeps a few warm ones
+# (page cache, prepared statements) and reuses the most recently used first.
+_POOL_SIZE = 8
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+_last_columns = (None, ())
+
+
+def _dict_factory(cursor, row):
+    """Rows as plain dicts: callers use .get() and st.cache_data pickles them."""
+    # A cursor keeps one description object for all rows of a statement, so
+    # the column names are extracted once per result set, not once per row.
+    global _last_columns
+    desc = cursor.description
+    last_desc, cols = _last_columns
+    if desc is not last_desc:
+        cols = tuple(col[0] for col in desc)
+        _last_columns = (desc, cols)
+    return dict(zip(cols, row))
+
+
+def _open_conn():
+    # check_same_thread=False: a pooled connection moves between threads, but
+    # only one caller holds it at a time. Roughly every distinct statement in
+    # this module fits in the statement cache. timeout is SQLite's busy
+    # timeout: a writer waits up to 5s for another writer instead of failing.
+    conn = sqlite3.connect(DB_FILE, timeout=5.0, check_same_thread=False, cached_statements=256)
+    conn.row_factory = _dict_factory
+    # Per-connection settings; journal_mode=WAL is persisted by init_db.
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Truncate the -wal file back to 64MB after checkpoints instead of
+    # leaving it at its high-water mark.
+    conn.execute("PRAGMA journal_size_limit=67108864")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+
+def _pool():
+    pool = _pools.get(DB_FILE)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(DB_FILE, queue.LifoQueue(maxsize=_POOL_SIZE))
+    return pool
+
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection for the current DB_FILE."""
+    pool = _pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_conn()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def close_db():
+    """Close every pooled connection (tests, shutdown)."""
+    _invalidate()
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# Short-lived cache for lookups made on nearly every page render. Writes in
+# this process invalidate it; the TTL bounds staleness from other processes
+# (runner.py) writing the same database. Callers get copies, so mutating a
+# returned dict can't corrupt the cache.
+_CACHE_TTL = 30
+_CACHE_MAX = 512
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _copy_rows(value):
+    if isinstance(value, list):
+        return [dict(r) for r in value]
+    return dict(value) if value is not None else None
+
+
+def _cached(kind, args, load):
+    key = (kind, DB_FILE) + args
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit is not None and hit[0] > now:
+        return _copy_rows(hit[1])
+    value = load()
+    with _cache_lock:
+        if len(_cache) >= _CACHE_MAX:
+            _cache.clear()
+        _cache[key] = (now + _CACHE_TTL, value)
+    return _copy_rows(value)
+
+
+def _invalidate(kind=None):
+    """Drop cached lookups of one kind ("user", "models"), or all of them."""
+    with _cache_lock:
+        if kind is None:
+            _cache.clear()
+        else:
+            for key in [k for k in _cache if k[0] == kind]:
+                del _cache[key]
+
+
 # ---------------------------------------------------------------------------
 # Fernet helpers (Task 10)
 # ---------------------------------------------------------------------------
@@ -82,189 +255,208 @@ def decrypt_api_key(stored):
 # Schema & Init
 # ---------------------------------------------------------------------------
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE,
-            password TEXT NOT NULL,
-            role TEXT NOT NULL,
-            name TEXT NOT NULL,
-            account_status TEXT DEFAULT 'active',
-            reset_token TEXT,
-            reset_token_expiry TEXT,
-            created_at TEXT
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS classes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            subject TEXT,
-            teacher_id INTEGER,
-            created_at TEXT,
-            FOREIGN KEY(teacher_id) REFERENCES users(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS class_students (
-            class_id INTEGER NOT NULL,
-            student_id INTEGER NOT NULL,
-            PRIMARY KEY(class_id, student_id),
-            FOREIGN KEY(class_id) REFERENCES classes(id),
-            FOREIGN KEY(student_id) REFERENCES users(id)
-        )
-    """)
-
-    # is_active: 1 = published (visible to teachers), 0 = draft
-    # managed_by: 'admin' = created in admin hub, 'teacher' = teacher's own model
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS models (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            model_name TEXT NOT NULL DEFAULT '',
-            api_url TEXT NOT NULL,
-            api_key TEXT,
-            system_prompt TEXT,
-            is_active INTEGER DEFAULT 1,
-            managed_by TEXT DEFAULT 'admin',
-            created_by INTEGER,
-            created_at TEXT,
-            FOREIGN KEY(created_by) REFERENCES users(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS student_model_access (
-            user_id INTEGER NOT NULL,
-            model_id INTEGER NOT NULL,
-            allowed INTEGER NOT NULL DEFAULT 1,
-            override_prompt TEXT,
-            PRIMARY KEY(user_id, model_id),
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(model_id) REFERENCES models(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS class_model_access (
-            class_id INTEGER NOT NULL,
-            model_id INTEGER NOT NULL,
-            allowed INTEGER NOT NULL DEFAULT 1,
-            override_prompt TEXT,
-            PRIMARY KEY(class_id, model_id),
-            FOREIGN KEY(class_id) REFERENCES classes(id),
-            FOREIGN KEY(model_id) REFERENCES models(id)
-        )
-    """)
+# Bump whenever init_db gains DDL so existing databases pick it up.
+SCHEMA_VERSION = 7
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS folders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            parent_id INTEGER,
-            created_by INTEGER,
-            created_at TEXT,
-            FOREIGN KEY(parent_id) REFERENCES folders(id),
-            FOREIGN KEY(created_by) REFERENCES users(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            file_type TEXT NOT NULL,
-            subject TEXT,
-            folder_id INTEGER,
-            index_status TEXT DEFAULT 'pending',
-            index_path TEXT,
-            uploaded_by INTEGER,
-            created_at TEXT,
-            FOREIGN KEY(folder_id) REFERENCES folders(id),
-            FOREIGN KEY(uploaded_by) REFERENCES users(id)
-        )
-    """)
 
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS model_rag_links (
-            model_id INTEGER NOT NULL,
-            document_id INTEGER NOT NULL,
-            PRIMARY KEY(model_id, document_id),
-            FOREIGN KEY(model_id) REFERENCES models(id),
-            FOREIGN KEY(document_id) REFERENCES documents(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS generated_questions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER,
-            question_type TEXT NOT NULL,
-            question TEXT NOT NULL,
-            options TEXT,
-            answer TEXT,
-            assigned_to INTEGER,
-            created_at TEXT,
-            FOREIGN KEY(document_id) REFERENCES documents(id),
-            FOREIGN KEY(assigned_to) REFERENCES users(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS deployments (
-            user_id INTEGER PRIMARY KEY,
-            port INTEGER UNIQUE NOT NULL,
-            pid INTEGER,
-            status TEXT,
-            updated_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS chat_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            session_id TEXT NOT NULL,
-            model_id INTEGER,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            token_estimate INTEGER DEFAULT 0,
-            created_at TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(model_id) REFERENCES models(id)
-        )
-    """)
-
-    # Task 2: Registration auth keys
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS system_keys (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            key_value TEXT UNIQUE NOT NULL,
-            target_role TEXT NOT NULL DEFAULT 'teacher',
-            used_by INTEGER,
-            created_at TEXT,
-            used_at TEXT,
-            FOREIGN KEY(used_by) REFERENCES users(id)
-        )
-    """)
-
-    conn.commit()
-    _migrate(c, conn)
-    _seed_accounts(conn, c)
-    conn.commit()
-    conn.close()
-
-
-def _migrate(c, conn):
+def init_db():
+    with get_conn() as conn:
+        c = conn.cursor()
+
+        # app.py calls init_db on every rerun; once the schema is current this is
+        # a single header read instead of a dozen DDL write transactions.
+        version = c.execute("PRAGMA user_version").fetchone()["user_version"]
+        if version >= SCHEMA_VERSION:
+            return
+
+        # WAL lets readers run alongside a writer and, with synchronous=NORMAL,
+        # drops the fsync from every commit. It is stored in the database file,
+        # so setting it once here is enough; it cannot change inside a transaction.
+        c.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            c.execute("BEGIN")
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE,
+                    password TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    account_status TEXT DEFAULT 'active',
+                    reset_token TEXT,
+                    reset_token_expiry TEXT,
+                    created_at TEXT
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS classes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    subject TEXT,
+                    teacher_id INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY(teacher_id) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS class_students (
+                    class_id INTEGER NOT NULL,
+                    student_id INTEGER NOT NULL,
+                    PRIMARY KEY(class_id, student_id),
+                    FOREIGN KEY(class_id) REFERENCES classes(id),
+                    FOREIGN KEY(student_id) REFERENCES users(id)
+                )
+            """)
+
+            # is_active: 1 = published (visible to teachers), 0 = draft
+            # managed_by: 'admin' = created in admin hub, 'teacher' = teacher's own model
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS models (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    model_name TEXT NOT NULL DEFAULT '',
+                    api_url TEXT NOT NULL,
+                    api_key TEXT,
+                    system_prompt TEXT,
+                    is_active INTEGER DEFAULT 1,
+                    managed_by TEXT DEFAULT 'admin',
+                    created_by INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY(created_by) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS student_model_access (
+                    user_id INTEGER NOT NULL,
+                    model_id INTEGER NOT NULL,
+                    allowed INTEGER NOT NULL DEFAULT 1,
+                    override_prompt TEXT,
+                    PRIMARY KEY(user_id, model_id),
+                    FOREIGN KEY(user_id) REFERENCES users(id),
+                    FOREIGN KEY(model_id) REFERENCES models(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS class_model_access (
+                    class_id INTEGER NOT NULL,
+                    model_id INTEGER NOT NULL,
+                    allowed INTEGER NOT NULL DEFAULT 1,
+                    override_prompt TEXT,
+                    PRIMARY KEY(class_id, model_id),
+                    FOREIGN KEY(class_id) REFERENCES classes(id),
+                    FOREIGN KEY(model_id) REFERENCES models(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS folders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    parent_id INTEGER,
+                    created_by INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY(parent_id) REFERENCES folders(id),
+                    FOREIGN KEY(created_by) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    file_type TEXT NOT NULL,
+                    subject TEXT,
+                    folder_id INTEGER,
+                    index_status TEXT DEFAULT 'pending',
+                    index_path TEXT,
+                    uploaded_by INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY(folder_id) REFERENCES folders(id),
+                    FOREIGN KEY(uploaded_by) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS model_rag_links (
+                    model_id INTEGER NOT NULL,
+                    document_id INTEGER NOT NULL,
+                    PRIMARY KEY(model_id, document_id),
+                    FOREIGN KEY(model_id) REFERENCES models(id),
+                    FOREIGN KEY(document_id) REFERENCES documents(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS generated_questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_id INTEGER,
+                    question_type TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    options TEXT,
+                    answer TEXT,
+                    assigned_to INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY(document_id) REFERENCES documents(id),
+                    FOREIGN KEY(assigned_to) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS deployments (
+                    user_id INTEGER PRIMARY KEY,
+                    port INTEGER UNIQUE NOT NULL,
+                    pid INTEGER,
+                    status TEXT,
+                    updated_at TEXT,
+                    FOREIGN KEY(user_id) REFERENCES users(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS chat_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    session_id TEXT NOT NULL,
+                    model_id INTEGER,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    token_estimate INTEGER DEFAULT 0,
+                    created_at TEXT,
+                    FOREIGN KEY(user_id) REFERENCES users(id),
+                    FOREIGN KEY(model_id) REFERENCES models(id)
+                )
+            """)
+
+            # Task 2: Registration auth keys
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS system_keys (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key_value TEXT UNIQUE NOT NULL,
+                    target_role TEXT NOT NULL DEFAULT 'teacher',
+                    used_by INTEGER,
+                    created_at TEXT,
+                    used_at TEXT,
+                    FOREIGN KEY(used_by) REFERENCES users(id)
+                )
+            """)
+
+            # The ALTER TABLE back-fills predate schema versioning: any database
+            # stamped with a version already has those columns.
+            if version < 1:
+                _migrate(c)
+            _create_indexes(c)
+            _create_triggers(c)
+            _seed_accounts(c)
+            c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def _migrate(c):
     migrations = [
         ("users", "email", "ALTER TABLE users ADD COLUMN email TEXT"),
         ("users", "account_status", "ALTER TABLE users ADD COLUMN account_status TEXT DEFAULT 'active'"),
@@ -278,134 +470,293 @@ def _migrate(c, conn):
         ("documents", "folder_id", "ALTER TABLE documents ADD COLUMN folder_id INTEGER"),
         ("chat_logs", "token_estimate", "ALTER TABLE chat_logs ADD COLUMN token_estimate INTEGER DEFAULT 0"),
     ]
+    columns = {}
     for table, col, sql in migrations:
+        if table not in columns:
+            columns[table] = {row["name"] for row in c.execute(f"PRAGMA table_info({table})")}
+        if col not in columns[table]:
+            c.execute(sql)
+
+
+def _create_indexes(c):
+    # Composite PKs only serve lookups on their leading column.
+    # model_id -> students (per-model access lists, delete_model)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sma_model ON student_model_access(model_id, user_id)")
+    # student -> classes (class branch of get_allowed_models_for_student)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_class_students_student ON class_students(student_id, class_id)")
+    # get_users_by_role: filter + ORDER BY username from the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, username)")
+    # Case-insensitive uniqueness (create_user also checks explicitly, for
+    # legacy databases where these fall back to plain indexes); they serve
+    # verify_user's and create_user's LOWER(username)/LOWER(email) lookups.
+    for col in ("username", "email"):
         try:
-            c.execute(f"SELECT {col} FROM {table} LIMIT 1")
-        except sqlite3.OperationalError:
-            try:
-                c.execute(sql)
-                conn.commit()
-            except Exception:
-                pass
+            c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_users_lower_{col} ON users(LOWER({col}))")
+        except sqlite3.IntegrityError:
+            # Legacy rows differing only by case: keep the lookup index.
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_users_lower_{col} ON users(LOWER({col}))")
+        else:
+            c.execute(f"DROP INDEX IF EXISTS idx_users_lower_{col}")
+    # get_questions_for_student / get_questions_for_document, delete_document
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gq_assigned ON generated_questions(assigned_to, created_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_gq_doc ON generated_questions(document_id)")
+    # cleanup_zombies / get_all_active_ports
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dep_status ON deployments(status)")
+    # get_classes_for_teacher, folder listings, delete_document's link cleanup
+    c.execute("CREATE INDEX IF NOT EXISTS idx_classes_teacher ON classes(teacher_id, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_documents_folder ON documents(folder_id, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mrl_doc ON model_rag_links(document_id)")
+    # per-student chat history and analytics, newest first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_user ON chat_logs(user_id, created_at)")
+
+
+def _create_triggers(c):
+    # ON DELETE CASCADE can't be added to existing tables without rebuilding
+    # them, so deleting a user cascades through a trigger instead.
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM student_model_access WHERE user_id=OLD.id;
+            DELETE FROM class_students WHERE student_id=OLD.id;
+            DELETE FROM chat_logs WHERE user_id=OLD.id;
+            DELETE FROM deployments WHERE user_id=OLD.id;
+            DELETE FROM generated_questions WHERE assigned_to=OLD.id;
+        END
+    """)
 
 
-def _seed_accounts(conn, c):
+def _seed_accounts(c):
+    """Insert the default accounts inside init_db's transaction."""
     seeds = [
         ("admin123", "admin123@123.com", "admin123", "admin", "System Admin"),
         ("teacher", "teacher@teacher.com", "teacher", "teacher", "Default Teacher"),
         ("student01", "student01@student01.com", "student01", "student", "Student One"),
     ]
-    for username, email, password, role, name in seeds:
-        c.execute("SELECT id FROM users WHERE username=?", (username,))
-        if not c.fetchone():
-            c.execute(
-                "INSERT OR IGNORE INTO users (username, email, password, role, name, account_status, created_at) "
-                "VALUES (?,?,?,?,?,'active',?)",
-                (username, email, hash_password(password), role, name, datetime.now().isoformat())
-            )
-    conn.commit()
+    # One lookup for all seeds; only missing ones pay for hashing a password.
+    c.execute(
+        "SELECT username FROM users WHERE username IN (%s)" % ",".join("?" * len(seeds)),
+        [s[0] for s in seeds]
+    )
+    existing = {r["username"] for r in c.fetchall()}
+    now = _now()
+    c.executemany(
+        "INSERT OR IGNORE INTO users (username, email, password, role, name, account_status, created_at) "
+        "VALUES (?,?,?,?,?,'active',?)",
+        [(username, email, hash_password(password), role, name, now)
+         for username, email, password, role, name in seeds if username not in existing]
+    )
 
 
 # ---------------------------------------------------------------------------
-# Password helpers (Task 9: bcrypt with SHA-256 fallback + auto-upgrade)
+# Password helpers (Task 9: bcrypt with scrypt fallback + auto-upgrade)
 # ---------------------------------------------------------------------------
 
+# Used when bcrypt isn't installed: salted scrypt from hashlib (OpenSSL),
+# stored in the same column as "scrypt$<salt hex>$<hash hex>".
+HAS_SCRYPT = hasattr(hashlib, "scrypt")
+_SCRYPT_PREFIX = "scrypt$"
+_SCRYPT_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1, "dklen": 32}
+
+def _pw_digest(password):
+    """Raw 32-byte SHA-256 of a password (legacy scheme, no salt)."""
+    return hashlib.sha256(password.encode("utf-8")).digest()
+
+
+def _sha256_hex(password):
+    """Legacy unsalted SHA-256 hex digest (last resort without bcrypt or scrypt)."""
+    return _pw_digest(password).hex()
+
+
+def _scrypt(password, salt):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, **_SCRYPT_PARAMS)
+
+
 def hash_password(password):
-    """Hash password using bcrypt if available, else SHA-256."""
+    """Hash password using bcrypt if available, else salted scrypt."""
     if HAS_BCRYPT:
         return _bcrypt.hashpw(password.encode("utf-8"), _bcrypt.gensalt()).decode("utf-8")
-    return hashlib.sha256(password.encode()).hexdigest()
+    if HAS_SCRYPT:
+        salt = os.urandom(16)
+        return f"{_SCRYPT_PREFIX}{salt.hex()}${_scrypt(password, salt).hex()}"
+    return _sha256_hex(password)
+
+
+def _needs_rehash(stored):
+    """True when stored isn't in the scheme hash_password currently produces."""
+    if HAS_BCRYPT:
+        return not stored.startswith("$2")
+    if HAS_SCRYPT:
+        return not stored.startswith(_SCRYPT_PREFIX)
+    return False
+
+
+def _check_scrypt(plain, stored):
+    try:
+        salt_hex, hash_hex = stored[len(_SCRYPT_PREFIX):].split("$")
+        salt, expected = bytes.fromhex(salt_hex), bytes.fromhex(hash_hex)
+    except ValueError:
+        return False
+    return hmac.compare_digest(_scrypt(plain, salt), expected)
+
+
+def _check_bcrypt(plain, stored):
+    return _bcrypt.checkpw(plain.encode("utf-8"), stored.encode("utf-8"))
+
+
+# bcrypt and scrypt are deliberately slow (~50-100ms+), so remember recent
+# successful checks. Entries are keyed by the stored hash (a password change misses) and
+# an HMAC of the password under a per-process random key; the plaintext is
+# never kept. Trade-off: anyone able to read this process's memory could test
+# guesses against the HMAC far faster than against the KDF, so the cache is
+# small and lives only as long as the process.
+_VERIFY_CACHE_MAX = 256
+_verify_cache = OrderedDict()
+_verify_cache_lock = threading.Lock()
+_verify_cache_key = secrets.token_bytes(32)
+
+
+def _checkpw_cached(plain, stored, check):
+    tag = (stored, hmac.new(_verify_cache_key, plain.encode("utf-8"), hashlib.sha256).digest())
+    with _verify_cache_lock:
+        if tag in _verify_cache:
+            _verify_cache.move_to_end(tag)
+            return True
+    if not check(plain, stored):
+        return False
+    with _verify_cache_lock:
+        _verify_cache[tag] = True
+        if len(_verify_cache) > _VERIFY_CACHE_MAX:
+            _verify_cache.popitem(last=False)
+    return True
 
 
 def _verify_password(plain, stored):
-    """Verify plain password against stored hash (bcrypt or SHA-256)."""
+    """Verify plain password against stored hash (bcrypt, scrypt or SHA-256)."""
     if stored.startswith("$2b$") or stored.startswith("$2a$"):
         if HAS_BCRYPT:
-            return _bcrypt.checkpw(plain.encode("utf-8"), stored.encode("utf-8"))
+            return _checkpw_cached(plain, stored, _check_bcrypt)
         return False
-    return hashlib.sha256(plain.encode()).hexdigest() == stored
+    if stored.startswith(_SCRYPT_PREFIX):
+        if HAS_SCRYPT:
+            return _checkpw_cached(plain, stored, _check_scrypt)
+        return False
+    # Compare raw digests (32 bytes, no hex encoding of the candidate) in
+    # constant time; == would short-circuit on the first differing byte.
+    try:
+        expected = bytes.fromhex(stored)
+    except ValueError:
+        return False
+    return hmac.compare_digest(_pw_digest(plain), expected)
 
 
 # ---------------------------------------------------------------------------
 # User CRUD
 # ---------------------------------------------------------------------------
 
+USER_DATA_DIR = "data"
+DELETED_DIR = os.path.join(USER_DATA_DIR, ".deleted")
+# data/<name> folders that belong to the app, not to an account.
+_RESERVED_USER_DIRS = {"documents", "system", ".deleted"}
+
+
+def _is_user_dir_name(username):
+    """True if data/<username> is a plain per-user folder we may create or move."""
+    return (
+        bool(username)
+        and os.path.basename(username) == username
+        and "/" not in username and "\\" not in username
+        and username not in (".", "..")
+        and username.lower() not in _RESERVED_USER_DIRS
+    )
+
+
 def create_user(username, password, role, name, email=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    try:
-        c.execute("SELECT id FROM users WHERE LOWER(username)=?", (username.lower(),))
+    if not _is_user_dir_name(username):
+        return False, "Invalid username"
+    with get_conn() as conn:
+        c = conn.cursor()
+        # Cheap pre-check so a duplicate never pays for the password hash; the
+        # guarded INSERT below stays the race-safe backstop.
+        c.execute(_SQL_USER_TAKEN, (username.lower(), email.lower() if email else None))
         if c.fetchone():
-            return False, "Username already taken"
-        if email:
-            c.execute("SELECT id FROM users WHERE LOWER(email)=?", (email.lower(),))
-            if c.fetchone():
-                return False, "Email already registered"
-        c.execute(
-            "INSERT INTO users (username, email, password, role, name, account_status, created_at) "
-            "VALUES (?,?,?,?,?,'active',?)",
-            (username, email, hash_password(password), role, name, datetime.now().isoformat())
-        )
-        conn.commit()
-        return True, "OK"
-    except sqlite3.IntegrityError as e:
-        return False, str(e)
-    finally:
-        conn.close()
+            return False, _taken_reason(c, username)
+        try:
+            # One atomic statement: the NOT EXISTS guard rejects case-insensitive
+            # duplicates even where uq_users_lower_* couldn't be built, and a
+            # plain INSERT still reports NOT NULL violations.
+            with conn:
+                c.execute(
+                    "INSERT INTO users (username, email, password, role, name, account_status, created_at) "
+                    "SELECT ?,?,?,?,?,'active',? WHERE NOT EXISTS (" + _SQL_USER_TAKEN + ")",
+                    (username, email, hash_password(password), role, name, _now(),
+                     username.lower(), email.lower() if email else None)
+                )
+            if c.rowcount == 1:
+                _invalidate("user")  # an earlier miss for this id may be cached
+                return True, "OK"
+        except sqlite3.IntegrityError as e:
+            if not str(e).startswith("UNIQUE"):
+                return False, str(e)
+            # lost a race with a concurrent insert of the same name or email
+        return False, _taken_reason(c, username)
+
+
+_SQL_USER_TAKEN = "SELECT 1 FROM users WHERE LOWER(username)=? OR LOWER(email)=?"
+
+
+def _taken_reason(c, username):
+    """Which of username/email clashed, once a duplicate is known to exist."""
+    c.execute("SELECT 1 FROM users WHERE LOWER(username)=?", (username.lower(),))
+    if c.fetchone():
+        return "Username already taken"
+    return "Email already registered"
+
+
+# The LOWER() text must match uq_users_lower_username/_email exactly: SQLite
+# then plans this as a MULTI-INDEX OR of two index seeks, no table scan.
+_SQL_VERIFY_USER = "SELECT * FROM users WHERE (LOWER(username)=? OR LOWER(email)=?)"
+_SQL_GET_USER_BY_ID = "SELECT * FROM users WHERE id=?"
 
 
 def verify_user(login, password):
-    """Login can be username or email. Auto-upgrades SHA-256 -> bcrypt on success."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM users WHERE (LOWER(username)=? OR LOWER(email)=?)",
-        (login.lower(), login.lower())
-    )
-    user = c.fetchone()
-    if user and _verify_password(password, user["password"]):
-        user_dict = dict(user)
-        # Auto-upgrade SHA-256 -> bcrypt (seamless)
-        if HAS_BCRYPT and not user["password"].startswith("$2"):
-            new_hash = hash_password(password)
-            c.execute("UPDATE users SET password=? WHERE id=?", (new_hash, user["id"]))
-            conn.commit()
-            user_dict["password"] = new_hash
-        conn.close()
-        return user_dict
-    conn.close()
-    return None
+    """Login can be username or email. Re-hashes older schemes on success."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(_SQL_VERIFY_USER, (login.lower(), login.lower()))
+        user = c.fetchone()
+        if user and _verify_password(password, user["password"]):
+            # Auto-upgrade SHA-256 / scrypt -> current scheme (seamless)
+            if _needs_rehash(user["password"]):
+                new_hash = hash_password(password)
+                with conn:
+                    c.execute("UPDATE users SET password=? WHERE id=?", (new_hash, user["id"]))
+                _invalidate("user")
+                user["password"] = new_hash
+            return user
+        return None
+
+
+def _load_user(user_id):
+    with get_conn() as conn:
+        return conn.execute(_SQL_GET_USER_BY_ID, (user_id,)).fetchone()
 
 
 def get_user_by_id(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id=?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return dict(user) if user else None
+    return _cached("user", (user_id,), lambda: _load_user(user_id))
 
 
 def get_all_users():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users ORDER BY role, username")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users ORDER BY role, username")
+        return c.fetchall()
 
 
 def get_users_by_role(role):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE role=? ORDER BY username", (role,))
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE role=? ORDER BY username", (role,))
+        return c.fetchall()
 
 
 def get_all_students():
@@ -416,78 +767,108 @@ def get_all_teachers():
     return get_users_by_role("teacher")
 
 
+# One fixed statement for every user edit (profile and admin), so sqlite3's
+# statement cache always hits. NULL keeps a column; email uses a flag because
+# clearing it means writing NULL.
+_SQL_UPDATE_USER = (
+    "UPDATE users SET username=COALESCE(?, username), password=COALESCE(?, password), "
+    "name=COALESCE(?, name), email=CASE WHEN ? THEN ? ELSE email END, "
+    "role=COALESCE(?, role) WHERE id=?"
+)
+
+
 def update_user_profile(user_id, new_username=None, new_password=None, new_name=None, new_email=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    fields, vals = [], []
-    if new_username:
-        fields.append("username=?"); vals.append(new_username)
-    if new_password:
-        fields.append("password=?"); vals.append(hash_password(new_password))
-    if new_name:
-        fields.append("name=?"); vals.append(new_name)
-    if new_email is not None:
-        fields.append("email=?"); vals.append(new_email or None)
-    if not fields:
-        conn.close()
+    if not (new_username or new_password or new_name or new_email is not None):
         return True, "No changes"
-    vals.append(user_id)
-    try:
-        c.execute(f"UPDATE users SET {', '.join(fields)} WHERE id=?", tuple(vals))
-        conn.commit()
-        return True, "OK"
-    except sqlite3.IntegrityError as e:
-        return False, str(e)
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        try:
+            with conn:
+                c.execute(_SQL_UPDATE_USER, (
+                    new_username or None,
+                    hash_password(new_password) if new_password else None,
+                    new_name or None,
+                    new_email is not None, new_email or None,
+                    None,
+                    user_id,
+                ))
+            _invalidate("user")
+            return True, "OK"
+        except sqlite3.IntegrityError as e:
+            return False, str(e)
 
 
 def admin_update_user(user_id, name, username, email=None, password=None, role=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    fields = ["name=?", "username=?"]
-    vals = [name, username]
-    if email is not None:
-        fields.append("email=?"); vals.append(email)
-    if password:
-        fields.append("password=?"); vals.append(hash_password(password))
-    if role:
-        fields.append("role=?"); vals.append(role)
-    vals.append(user_id)
-    try:
-        c.execute(f"UPDATE users SET {', '.join(fields)} WHERE id=?", tuple(vals))
-        conn.commit()
-        return True, "OK"
-    except sqlite3.IntegrityError as e:
-        return False, str(e)
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        try:
+            with conn:
+                c.execute(_SQL_UPDATE_USER, (
+                    username,
+                    hash_password(password) if password else None,
+                    name,
+                    email is not None, email,
+                    role or None,
+                    user_id,
+                ))
+            _invalidate("user")
+            return True, "OK"
+        except sqlite3.IntegrityError as e:
+            return False, str(e)
 
 
 def update_user_status(user_id, status):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE users SET account_status=? WHERE id=?", (status, user_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("UPDATE users SET account_status=? WHERE id=?", (status, user_id))
+    _invalidate("user")
+
+
+def _archive_user_dir(username):
+    """Move data/<username> aside so a new account with the same name starts clean."""
+    if not _is_user_dir_name(username):
+        return  # legacy rows may predate the create_user check
+    src = os.path.join(USER_DATA_DIR, username)
+    if os.path.dirname(os.path.realpath(src)) != os.path.realpath(USER_DATA_DIR) or not os.path.isdir(src):
+        return
+    try:
+        os.makedirs(DELETED_DIR, exist_ok=True)
+        os.replace(src, os.path.join(DELETED_DIR, f"{username}-{datetime.now():%Y%m%d%H%M%S}"))
+    except OSError:
+        pass
 
 
 def delete_user(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for tbl in ("student_model_access", "class_students", "chat_logs"):
-        c.execute(f"DELETE FROM {tbl} WHERE user_id=?", (user_id,))
-    c.execute("DELETE FROM generated_questions WHERE assigned_to=?", (user_id,))
-    c.execute("DELETE FROM users WHERE id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        # trg_users_delete removes the user's access, memberships, logs,
+        # deployments and assigned questions in the same statement.
+        with conn:
+            rows = c.execute("DELETE FROM users WHERE id=? RETURNING username", (user_id,)).fetchall()
+        _invalidate("user")
+        # Only after the rows are gone; the caller doesn't wait on the disk.
+        row = rows[0] if rows else None
+        if row and row["username"]:
+            threading.Thread(target=_archive_user_dir, args=(row["username"],), daemon=True).start()
+
+
+_PARALLEL_HASH_MIN = 4
 
 
 def import_students_from_csv(csv_text):
     """Parse CSV 'username,email,name,password' and bulk-create students."""
     reader = csv.reader(io.StringIO(csv_text))
-    ok_count = 0
     errors = []
+    # Duplicate checks run against one snapshot of existing names/emails (and
+    # the rows accepted so far) instead of two queries per row.
+    with get_conn() as conn:
+        taken_names, taken_emails = set(), set()
+        for r in conn.execute("SELECT LOWER(username) AS u, LOWER(email) AS e FROM users"):
+            taken_names.add(r["u"])
+            if r["e"]:
+                taken_emails.add(r["e"])
+    accepted = []
     for i, row in enumerate(reader, 1):
         row = [c.strip() for c in row]
         if not row or (len(row) == 1 and not row[0]):
@@ -498,11 +879,43 @@ def import_students_from_csv(csv_text):
             errors.append(f"Row {i}: expected 4 columns, got {len(row)}: {row}")
             continue
         username, email, name, password = row[0], row[1], row[2], row[3]
-        ok, msg = create_user(username, password, "student", name or username, email=email or None)
-        if ok:
-            ok_count += 1
-        else:
-            errors.append(f"Row {i} ({username}): {msg}")
+        if not _is_user_dir_name(username):
+            errors.append(f"Row {i} ({username}): Invalid username")
+            continue
+        if username.lower() in taken_names:
+            errors.append(f"Row {i} ({username}): Username already taken")
+            continue
+        if email and email.lower() in taken_emails:
+            errors.append(f"Row {i} ({username}): Email already registered")
+            continue
+        taken_names.add(username.lower())
+        if email:
+            taken_emails.add(email.lower())
+        accepted.append((username, email or None, password, name or username))
+    if not accepted:
+        return 0, errors
+    # Hash before taking the write lock; bcrypt is the slow part. bcrypt and
+    # scrypt release the GIL, so large imports hash on several threads.
+    passwords = [pw for _, _, pw, _ in accepted]
+    if len(passwords) >= _PARALLEL_HASH_MIN and (HAS_BCRYPT or HAS_SCRYPT):
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+            hashes = list(ex.map(hash_password, passwords))
+    else:
+        hashes = [hash_password(pw) for pw in passwords]
+    now = _now()
+    params = [(u, e, h, "student", n, now) for (u, e, _, n), h in zip(accepted, hashes)]
+    with get_conn() as conn:
+        before = conn.total_changes
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (username, email, password, role, name, account_status, created_at) "
+                "VALUES (?,?,?,?,?,'active',?)",
+                params
+            )
+        ok_count = conn.total_changes - before
+    _invalidate("user")
+    if ok_count < len(params):
+        errors.append(f"{len(params) - ok_count} row(s) skipped: username or email registered meanwhile")
     return ok_count, errors
 
 
@@ -511,109 +924,90 @@ def import_students_from_csv(csv_text):
 # ---------------------------------------------------------------------------
 
 def create_class(name, teacher_id, subject=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO classes (name, subject, teacher_id, created_at) VALUES (?,?,?,?)",
-        (name, subject, teacher_id, datetime.now().isoformat())
-    )
-    class_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return class_id
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT INTO classes (name, subject, teacher_id, created_at) VALUES (?,?,?,?)",
+                (name, subject, teacher_id, _now())
+            )
+            class_id = c.lastrowid
+        return class_id
 
 
 def get_classes_for_teacher(teacher_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM classes WHERE teacher_id=? ORDER BY name", (teacher_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM classes WHERE teacher_id=? ORDER BY name", (teacher_id,))
+        return c.fetchall()
 
 
 def get_all_classes():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT c.*, u.name as teacher_name FROM classes c "
-        "LEFT JOIN users u ON c.teacher_id=u.id ORDER BY c.name"
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT c.id, c.name, c.subject, c.teacher_id, c.created_at, u.name as teacher_name "
+            "FROM classes c LEFT JOIN users u ON c.teacher_id=u.id ORDER BY c.name"
+        )
+        return c.fetchall()
 
 
 def update_class(class_id, name=None, subject=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    if name:
-        c.execute("UPDATE classes SET name=? WHERE id=?", (name, class_id))
-    if subject is not None:
-        c.execute("UPDATE classes SET subject=? WHERE id=?", (subject, class_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            if name:
+                c.execute("UPDATE classes SET name=? WHERE id=?", (name, class_id))
+            if subject is not None:
+                c.execute("UPDATE classes SET subject=? WHERE id=?", (subject, class_id))
 
 
 def delete_class(class_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for tbl in ("class_students", "class_model_access"):
-        c.execute(f"DELETE FROM {tbl} WHERE class_id=?", (class_id,))
-    c.execute("DELETE FROM classes WHERE id=?", (class_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            for tbl in ("class_students", "class_model_access"):
+                c.execute(f"DELETE FROM {tbl} WHERE class_id=?", (class_id,))
+            c.execute("DELETE FROM classes WHERE id=?", (class_id,))
 
 
 def add_student_to_class(class_id, student_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    try:
-        c.execute(
-            "INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?,?)",
-            (class_id, student_id)
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT OR IGNORE INTO class_students (class_id, student_id) VALUES (?,?)",
+                (class_id, student_id)
+            )
 
 
 def remove_student_from_class(class_id, student_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM class_students WHERE class_id=? AND student_id=?", (class_id, student_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("DELETE FROM class_students WHERE class_id=? AND student_id=?", (class_id, student_id))
 
 
 def get_students_in_class(class_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT u.* FROM users u JOIN class_students cs ON u.id=cs.student_id "
-        "WHERE cs.class_id=? ORDER BY u.username",
-        (class_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT u.* FROM users u JOIN class_students cs ON u.id=cs.student_id "
+            "WHERE cs.class_id=? ORDER BY u.username",
+            (class_id,)
+        )
+        return c.fetchall()
 
 
 def get_classes_for_student(student_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT c.* FROM classes c JOIN class_students cs ON c.id=cs.class_id "
-        "WHERE cs.student_id=? ORDER BY c.name",
-        (student_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT c.* FROM classes c JOIN class_students cs ON c.id=cs.class_id "
+            "WHERE cs.student_id=? ORDER BY c.name",
+            (student_id,)
+        )
+        return c.fetchall()
 
 
 # ---------------------------------------------------------------------------
@@ -622,45 +1016,44 @@ def get_classes_for_student(student_id):
 
 def create_model(name, model_name, api_url, api_key=None, system_prompt=None,
                  created_by=None, is_active=1, managed_by="admin"):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    try:
-        c.execute(
-            "INSERT INTO models (name, model_name, api_url, api_key, system_prompt, "
-            "is_active, managed_by, created_by, created_at) VALUES (?,?,?,?,?,?,?,?,?)",
-            (name, model_name, api_url, encrypt_api_key(api_key), system_prompt,
-             is_active, managed_by, created_by, datetime.now().isoformat())
-        )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        try:
+            with conn:
+                c.execute(
+                    "INSERT INTO models (name, model_name, api_url, api_key, system_prompt, "
+                    "is_active, managed_by, created_by, created_at) VALUES (?,?,?,?,?,?,?,?,?)",
+                    (name, model_name, api_url, encrypt_api_key(api_key), system_prompt,
+                     is_active, managed_by, created_by, _now())
+                )
+            _invalidate("models")
+            return True
+        except sqlite3.IntegrityError:
+            return False
 
 
 def get_models(created_by=None, include_inactive=True):
     """Return all (or filtered) models, with api_key decrypted."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if created_by is not None:
-        c.execute(
-            "SELECT * FROM models WHERE (created_by=? OR created_by IS NULL) ORDER BY name",
-            (created_by,)
-        )
-    elif include_inactive:
-        c.execute("SELECT * FROM models ORDER BY name")
-    else:
-        c.execute("SELECT * FROM models WHERE is_active=1 ORDER BY name")
-    rows = c.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        d = dict(r)
-        d["api_key"] = decrypt_api_key(d.get("api_key"))
-        result.append(d)
-    return result
+    return _cached("models", (created_by, include_inactive),
+                   lambda: _load_models(created_by, include_inactive))
+
+
+def _load_models(created_by, include_inactive):
+    with get_conn() as conn:
+        c = conn.cursor()
+        if created_by is not None:
+            c.execute(
+                "SELECT * FROM models WHERE (created_by=? OR created_by IS NULL) ORDER BY name",
+                (created_by,)
+            )
+        elif include_inactive:
+            c.execute("SELECT * FROM models ORDER BY name")
+        else:
+            c.execute("SELECT * FROM models WHERE is_active=1 ORDER BY name")
+        rows = c.fetchall()
+        for d in rows:
+            d["api_key"] = decrypt_api_key(d.get("api_key"))
+        return rows
 
 
 def get_published_models():
@@ -668,38 +1061,39 @@ def get_published_models():
     return get_models(include_inactive=False)
 
 
+@lru_cache(maxsize=64)
+def _update_sql(table, cols):
+    """UPDATE statement for a tuple of columns. Built once per column set, so
+    repeated edits of the same shape reuse sqlite3's prepared statement."""
+    return f"UPDATE {table} SET {', '.join(f'{col}=?' for col in cols)} WHERE id=?"
+
+
 def update_model(model_id, name=None, model_name=None, api_url=None,
                  api_key=None, system_prompt=None, is_active=None, managed_by=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    fields, vals = [], []
-    for col, val in [("name", name), ("model_name", model_name), ("api_url", api_url),
-                     ("system_prompt", system_prompt)]:
-        if val is not None:
-            fields.append(f"{col}=?"); vals.append(val)
     if api_key is not None:
-        fields.append("api_key=?"); vals.append(encrypt_api_key(api_key))
-    if is_active is not None:
-        fields.append("is_active=?"); vals.append(is_active)
-    if managed_by is not None:
-        fields.append("managed_by=?"); vals.append(managed_by)
-    if not fields:
-        conn.close()
+        api_key = encrypt_api_key(api_key)
+    changes = [(col, val) for col, val in (
+        ("name", name), ("model_name", model_name), ("api_url", api_url),
+        ("system_prompt", system_prompt), ("api_key", api_key),
+        ("is_active", is_active), ("managed_by", managed_by),
+    ) if val is not None]
+    if not changes:
         return
-    vals.append(model_id)
-    c.execute(f"UPDATE models SET {', '.join(fields)} WHERE id=?", tuple(vals))
-    conn.commit()
-    conn.close()
+    cols, vals = zip(*changes)
+    with get_conn() as conn:
+        with conn:
+            conn.execute(_update_sql("models", cols), (*vals, model_id))
+    _invalidate("models")
 
 
 def delete_model(model_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    for tbl in ("student_model_access", "class_model_access", "model_rag_links"):
-        c.execute(f"DELETE FROM {tbl} WHERE model_id=?", (model_id,))
-    c.execute("DELETE FROM models WHERE id=?", (model_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            for tbl in ("student_model_access", "class_model_access", "model_rag_links"):
+                c.execute(f"DELETE FROM {tbl} WHERE model_id=?", (model_id,))
+            c.execute("DELETE FROM models WHERE id=?", (model_id,))
+    _invalidate("models")
 
 
 # ---------------------------------------------------------------------------
@@ -709,15 +1103,14 @@ def delete_model(model_id):
 def create_system_key(target_role="teacher"):
     """Generate a new registration key. Returns the key string."""
     key = secrets.token_hex(12).upper()
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO system_keys (key_value, target_role, created_at) VALUES (?,?,?)",
-        (key, target_role, datetime.now().isoformat())
-    )
-    conn.commit()
-    conn.close()
-    return key
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT INTO system_keys (key_value, target_role, created_at) VALUES (?,?,?)",
+                (key, target_role, _now())
+            )
+        return key
 
 
 def create_system_keys_bulk(n, target_role="teacher"):
@@ -727,132 +1120,138 @@ def create_system_keys_bulk(n, target_role="teacher"):
 
 def list_system_keys(used=None):
     """Return all keys. used=True/False/None to filter."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if used is True:
-        c.execute(
-            "SELECT k.*, u.username as used_by_username FROM system_keys k "
-            "LEFT JOIN users u ON k.used_by=u.id WHERE k.used_by IS NOT NULL "
-            "ORDER BY k.created_at DESC"
-        )
-    elif used is False:
-        c.execute(
-            "SELECT k.*, NULL as used_by_username FROM system_keys k "
-            "WHERE k.used_by IS NULL ORDER BY k.created_at DESC"
-        )
-    else:
-        c.execute(
-            "SELECT k.*, u.username as used_by_username FROM system_keys k "
-            "LEFT JOIN users u ON k.used_by=u.id ORDER BY k.created_at DESC"
-        )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        if used is True:
+            c.execute(
+                "SELECT k.*, u.username as used_by_username FROM system_keys k "
+                "LEFT JOIN users u ON k.used_by=u.id WHERE k.used_by IS NOT NULL "
+                "ORDER BY k.created_at DESC"
+            )
+        elif used is False:
+            c.execute(
+                "SELECT k.*, NULL as used_by_username FROM system_keys k "
+                "WHERE k.used_by IS NULL ORDER BY k.created_at DESC"
+            )
+        else:
+            c.execute(
+                "SELECT k.*, u.username as used_by_username FROM system_keys k "
+                "LEFT JOIN users u ON k.used_by=u.id ORDER BY k.created_at DESC"
+            )
+        return c.fetchall()
 
 
 def use_system_key(key_value, user_id):
     """Mark a key as used. Returns (ok, target_role)."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM system_keys WHERE UPPER(key_value)=? AND used_by IS NULL",
-        (key_value.upper().strip(),)
-    )
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return False, None
-    c.execute(
-        "UPDATE system_keys SET used_by=?, used_at=? WHERE id=?",
-        (user_id, datetime.now().isoformat(), row["id"])
-    )
-    conn.commit()
-    conn.close()
-    return True, row["target_role"]
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                # Keys are generated upper-case, so the UNIQUE index on
+                # key_value serves this; UPPER(key_value) would scan the table.
+                "SELECT * FROM system_keys WHERE key_value=? AND used_by IS NULL",
+                (key_value.upper().strip(),)
+            )
+            row = c.fetchone()
+            if not row:
+                return False, None
+            c.execute(
+                "UPDATE system_keys SET used_by=?, used_at=? WHERE id=?",
+                (user_id, _now(), row["id"])
+            )
+        return True, row["target_role"]
 
 
 def delete_system_key(key_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM system_keys WHERE id=?", (key_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("DELETE FROM system_keys WHERE id=?", (key_id,))
 
 
 # ---------------------------------------------------------------------------
 # Model Access
 # ---------------------------------------------------------------------------
 
+_SQL_UPSERT_STUDENT_ACCESS = (
+    "INSERT INTO student_model_access (user_id, model_id, allowed, override_prompt) VALUES (?,?,?,?) "
+    "ON CONFLICT(user_id, model_id) DO UPDATE SET allowed=excluded.allowed, override_prompt=excluded.override_prompt"
+)
+
+
 def set_student_model_access(user_id, model_id, allowed, override_prompt=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO student_model_access (user_id, model_id, allowed, override_prompt) VALUES (?,?,?,?) "
-        "ON CONFLICT(user_id, model_id) DO UPDATE SET allowed=excluded.allowed, override_prompt=excluded.override_prompt",
-        (user_id, model_id, 1 if allowed else 0, override_prompt)
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(_SQL_UPSERT_STUDENT_ACCESS, (user_id, model_id, 1 if allowed else 0, override_prompt))
+
+
+def set_student_model_access_bulk(rows):
+    """Upsert many (user_id, model_id, allowed, override_prompt) rows in one transaction."""
+    params = [(uid, mid, 1 if allowed else 0, override) for uid, mid, allowed, override in rows]
+    if not params:
+        return
+    with get_conn() as conn:
+        with conn:
+            conn.executemany(_SQL_UPSERT_STUDENT_ACCESS, params)
 
 
 def set_class_model_access(class_id, model_id, allowed, override_prompt=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO class_model_access (class_id, model_id, allowed, override_prompt) VALUES (?,?,?,?) "
-        "ON CONFLICT(class_id, model_id) DO UPDATE SET allowed=excluded.allowed, override_prompt=excluded.override_prompt",
-        (class_id, model_id, 1 if allowed else 0, override_prompt)
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT INTO class_model_access (class_id, model_id, allowed, override_prompt) VALUES (?,?,?,?) "
+                "ON CONFLICT(class_id, model_id) DO UPDATE SET allowed=excluded.allowed, override_prompt=excluded.override_prompt",
+                (class_id, model_id, 1 if allowed else 0, override_prompt)
+            )
+
+
+# Direct and class grants in one pass; per model the first non-NULL override
+# wins, a direct (student-level) one before any class one.
+_SQL_ALLOWED_MODELS = (
+    "WITH grants AS ("
+    "  SELECT model_id, override_prompt, 1 AS src FROM student_model_access "
+    "  WHERE user_id=? AND allowed=1 "
+    "  UNION ALL "
+    "  SELECT cma.model_id, cma.override_prompt, 2 FROM class_model_access cma "
+    "  JOIN class_students cs ON cma.class_id=cs.class_id "
+    "  WHERE cs.student_id=? AND cma.allowed=1"
+    "), best AS ("
+    "  SELECT model_id, override_prompt, ROW_NUMBER() OVER ("
+    "    PARTITION BY model_id ORDER BY override_prompt IS NULL, src) AS rn FROM grants"
+    ") "
+    "SELECT m.*, b.override_prompt FROM models m JOIN best b ON b.model_id=m.id AND b.rn=1 "
+    "WHERE m.is_active=1 ORDER BY m.name"
+)
 
 
 def get_allowed_models_for_student(user_id):
-    """Union of class grants + direct grants. Returns full model dicts (key decrypted)."""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT DISTINCT m.* FROM models m WHERE m.is_active=1 AND m.id IN ("
-        "  SELECT sma.model_id FROM student_model_access sma "
-        "  WHERE sma.user_id=? AND sma.allowed=1 "
-        "  UNION "
-        "  SELECT cma.model_id FROM class_model_access cma "
-        "  JOIN class_students cs ON cma.class_id=cs.class_id "
-        "  WHERE cs.student_id=? AND cma.allowed=1"
-        ") ORDER BY m.name",
-        (user_id, user_id)
-    )
-    rows = c.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        d = dict(r)
-        d["api_key"] = decrypt_api_key(d.get("api_key"))
-        result.append(d)
-    return result
+    """Union of class grants + direct grants. Returns full model dicts (key decrypted)
+    plus the override_prompt that applies to this student."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(_SQL_ALLOWED_MODELS, (user_id, user_id))
+        rows = c.fetchall()
+        for d in rows:
+            d["api_key"] = decrypt_api_key(d.get("api_key"))
+        return rows
 
 
 def get_class_model_access(class_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM class_model_access WHERE class_id=?", (class_id,))
-    rows = c.fetchall()
-    conn.close()
-    return {r["model_id"]: dict(r) for r in rows}
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM class_model_access WHERE class_id=?", (class_id,))
+        rows = c.fetchall()
+        return {r["model_id"]: r for r in rows}
 
 
 def get_student_model_access_map(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM student_model_access WHERE user_id=?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return {r["model_id"]: dict(r) for r in rows}
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM student_model_access WHERE user_id=?", (user_id,))
+        rows = c.fetchall()
+        return {r["model_id"]: r for r in rows}
 
 
 # ---------------------------------------------------------------------------
@@ -860,40 +1259,35 @@ def get_student_model_access_map(user_id):
 # ---------------------------------------------------------------------------
 
 def set_model_rag_links(model_id, doc_ids):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM model_rag_links WHERE model_id=?", (model_id,))
-    for did in doc_ids:
-        c.execute(
-            "INSERT OR IGNORE INTO model_rag_links (model_id, document_id) VALUES (?,?)",
-            (model_id, did)
-        )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("DELETE FROM model_rag_links WHERE model_id=?", (model_id,))
+            c.executemany(
+                "INSERT OR IGNORE INTO model_rag_links (model_id, document_id) VALUES (?,?)",
+                [(model_id, did) for did in doc_ids]
+            )
 
 
 def get_rag_docs_for_model(model_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT d.* FROM documents d JOIN model_rag_links mrl ON d.id=mrl.document_id "
-        "WHERE mrl.model_id=? AND d.index_status='indexed'",
-        (model_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    """Indexed documents linked to a model; only what retrieval needs."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT d.id, d.name, d.index_path FROM documents d "
+            "JOIN model_rag_links mrl ON d.id=mrl.document_id "
+            "WHERE mrl.model_id=? AND d.index_status='indexed'",
+            (model_id,)
+        )
+        return c.fetchall()
 
 
 def get_rag_link_ids_for_model(model_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT document_id FROM model_rag_links WHERE model_id=?", (model_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [r["document_id"] for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT document_id FROM model_rag_links WHERE model_id=?", (model_id,))
+        rows = c.fetchall()
+        return [r["document_id"] for r in rows]
 
 
 # ---------------------------------------------------------------------------
@@ -901,49 +1295,43 @@ def get_rag_link_ids_for_model(model_id):
 # ---------------------------------------------------------------------------
 
 def create_folder(name, parent_id=None, created_by=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO folders (name, parent_id, created_by, created_at) VALUES (?,?,?,?)",
-        (name, parent_id, created_by, datetime.now().isoformat())
-    )
-    fid = c.lastrowid
-    conn.commit()
-    conn.close()
-    return fid
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT INTO folders (name, parent_id, created_by, created_at) VALUES (?,?,?,?)",
+                (name, parent_id, created_by, _now())
+            )
+            fid = c.lastrowid
+        return fid
 
 
 def get_folders(parent_id=None):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if parent_id is None:
-        c.execute("SELECT * FROM folders WHERE parent_id IS NULL ORDER BY name")
-    else:
-        c.execute("SELECT * FROM folders WHERE parent_id=? ORDER BY name", (parent_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        if parent_id is None:
+            c.execute("SELECT * FROM folders WHERE parent_id IS NULL ORDER BY name")
+        else:
+            c.execute("SELECT * FROM folders WHERE parent_id=? ORDER BY name", (parent_id,))
+        return c.fetchall()
 
 
 def get_all_folders():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM folders ORDER BY name")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM folders ORDER BY name")
+        return c.fetchall()
 
 
 def delete_folder(folder_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE documents SET folder_id=NULL WHERE folder_id=?", (folder_id,))
-    c.execute("UPDATE folders SET parent_id=NULL WHERE parent_id=?", (folder_id,))
-    c.execute("DELETE FROM folders WHERE id=?", (folder_id,))
-    conn.commit()
-    conn.close()
+    """Delete one folder. Its documents become unfoldered and its subfolders
+    move to the top level, all in one transaction - no subtree walk needed."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("UPDATE documents SET folder_id=NULL WHERE folder_id=?", (folder_id,))
+            c.execute("UPDATE folders SET parent_id=NULL WHERE parent_id=?", (folder_id,))
+            c.execute("DELETE FROM folders WHERE id=?", (folder_id,))
 
 
 # ---------------------------------------------------------------------------
@@ -951,130 +1339,171 @@ def delete_folder(folder_id):
 # ---------------------------------------------------------------------------
 
 def save_document(name, file_path, file_type, subject=None, folder_id=None, uploaded_by=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO documents (name, file_path, file_type, subject, folder_id, "
-        "index_status, uploaded_by, created_at) VALUES (?,?,?,?,?,'pending',?,?)",
-        (name, file_path, file_type, subject, folder_id, uploaded_by, datetime.now().isoformat())
-    )
-    did = c.lastrowid
-    conn.commit()
-    conn.close()
-    return did
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                "INSERT INTO documents (name, file_path, file_type, subject, folder_id, "
+                "index_status, uploaded_by, created_at) VALUES (?,?,?,?,?,'pending',?,?)",
+                (name, file_path, file_type, subject, folder_id, uploaded_by, _now())
+            )
+            did = c.lastrowid
+        return did
 
 
 def get_documents(folder_id=None, include_unfoldered=False):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if folder_id is not None:
-        c.execute("SELECT * FROM documents WHERE folder_id=? ORDER BY name", (folder_id,))
-    elif include_unfoldered:
-        c.execute("SELECT * FROM documents WHERE folder_id IS NULL ORDER BY name")
-    else:
-        c.execute("SELECT * FROM documents ORDER BY name")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        if folder_id is not None:
+            c.execute("SELECT * FROM documents WHERE folder_id=? ORDER BY name", (folder_id,))
+        elif include_unfoldered:
+            c.execute("SELECT * FROM documents WHERE folder_id IS NULL ORDER BY name")
+        else:
+            c.execute("SELECT * FROM documents ORDER BY name")
+        return c.fetchall()
+
+
+def get_indexed_documents():
+    """Documents ready for retrieval, by name; only what pickers and retrieval need."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, index_path FROM documents "
+                  "WHERE index_status='indexed' ORDER BY name")
+        return c.fetchall()
 
 
 def get_document(doc_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM documents WHERE id=?", (doc_id,))
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM documents WHERE id=?", (doc_id,))
+        return c.fetchone()
 
 
 def update_document_index(doc_id, index_path, status="indexed"):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE documents SET index_path=?, index_status=? WHERE id=?",
-              (index_path, status, doc_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("UPDATE documents SET index_path=?, index_status=? WHERE id=?",
+                      (index_path, status, doc_id))
 
 
 def move_document_to_folder(doc_id, folder_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE documents SET folder_id=? WHERE id=?", (folder_id, doc_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("UPDATE documents SET folder_id=? WHERE id=?", (folder_id, doc_id))
 
 
 def delete_document(doc_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM model_rag_links WHERE document_id=?", (doc_id,))
-    c.execute("DELETE FROM generated_questions WHERE document_id=?", (doc_id,))
-    c.execute("DELETE FROM documents WHERE id=?", (doc_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("DELETE FROM model_rag_links WHERE document_id=?", (doc_id,))
+            c.execute("DELETE FROM generated_questions WHERE document_id=?", (doc_id,))
+            c.execute("DELETE FROM documents WHERE id=?", (doc_id,))
 
 
 # ---------------------------------------------------------------------------
 # Questions
 # ---------------------------------------------------------------------------
 
+_SQL_INSERT_QUESTION = (
+    "INSERT INTO generated_questions (document_id, question_type, question, options, answer, "
+    "assigned_to, created_at) VALUES (?,?,?,?,?,?,?)"
+)
+
+
 def save_generated_question(document_id, question_type, question,
                              options=None, answer=None, assigned_to=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO generated_questions (document_id, question_type, question, options, answer, "
-        "assigned_to, created_at) VALUES (?,?,?,?,?,?,?)",
-        (document_id, question_type, question,
-         json.dumps(options) if options else None, answer,
-         assigned_to, datetime.now().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(
+                _SQL_INSERT_QUESTION,
+                (document_id, question_type, question,
+                 _json_dumps(options) if options else None, answer,
+                 assigned_to, _now())
+            )
+
+
+def save_generated_questions(items):
+    """Insert many (document_id, question_type, question, options, answer, assigned_to)
+    rows in one transaction."""
+    now = _now()
+    params = [(did, qtype, q, _json_dumps(opts) if opts else None, ans, aid, now)
+              for did, qtype, q, opts, ans, aid in items]
+    if not params:
+        return
+    with get_conn() as conn:
+        with conn:
+            conn.executemany(_SQL_INSERT_QUESTION, params)
 
 
 def get_questions_for_document(doc_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM generated_questions WHERE document_id=? ORDER BY created_at DESC", (doc_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [_parse_q(dict(r)) for r in rows]
-
-
-def get_questions_for_student(student_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT gq.*, d.name as doc_name FROM generated_questions gq "
-        "LEFT JOIN documents d ON gq.document_id=d.id "
-        "WHERE gq.assigned_to=? OR gq.assigned_to IS NULL ORDER BY gq.created_at DESC",
-        (student_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [_parse_q(dict(r)) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.row_factory = _question_row
+        c.execute("SELECT * FROM generated_questions WHERE document_id=? ORDER BY created_at DESC", (doc_id,))
+        return c.fetchall()
+
+
+_SQL_STUDENT_QUESTIONS_WHERE = "WHERE gq.assigned_to=? OR gq.assigned_to IS NULL"
+# The OR as two branches that each read idx_gq_assigned newest first: SQLite
+# merges them and stops after LIMIT+OFFSET rows, so only the page is sorted
+# and joined to documents instead of every question the student can see.
+_SQL_STUDENT_QUESTIONS = (
+    "SELECT q.*, d.name as doc_name FROM ("
+    "SELECT {cols} FROM generated_questions gq WHERE gq.assigned_to=? "
+    "UNION ALL "
+    "SELECT {cols} FROM generated_questions gq WHERE gq.assigned_to IS NULL "
+    "ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    ") q LEFT JOIN documents d ON q.document_id=d.id ORDER BY q.created_at DESC"
+)
+
+
+def count_questions_for_student(student_id):
+    with get_conn() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) AS n FROM generated_questions gq {_SQL_STUDENT_QUESTIONS_WHERE}",
+            (student_id,)
+        ).fetchone()["n"]
+
+
+def get_questions_for_student(student_id, include_options=True, limit=None, offset=0):
+    """Questions assigned to the student or to everyone, newest first.
+    include_options=False skips reading and JSON-decoding options for list
+    views; limit/offset fetch one page."""
+    with get_conn() as conn:
+        c = conn.cursor()
+        if include_options:
+            c.row_factory = _question_row
+            cols = "gq.*"
+        else:
+            cols = "gq.id, gq.document_id, gq.question_type, gq.question, gq.answer, gq.assigned_to, gq.created_at"
+        # LIMIT -1 means no limit, so paged and unpaged calls share one statement.
+        c.execute(
+            _SQL_STUDENT_QUESTIONS.format(cols=cols),
+            (student_id, -1 if limit is None else limit, offset)
+        )
+        return c.fetchall()
 
 
-def _parse_q(d):
-    if d.get("options") and isinstance(d["options"], str):
+def _question_row(cursor, row):
+    """Row factory for generated_questions: decodes options while building the dict."""
+    d = _dict_factory(cursor, row)
+    if d.get("options"):
         try:
-            d["options"] = json.loads(d["options"])
-        except Exception:
+            d["options"] = _json_loads(d["options"])
+        except ValueError:
             pass
     return d
 
 
 def delete_question(question_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM generated_questions WHERE id=?", (question_id,))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("DELETE FROM generated_questions WHERE id=?", (question_id,))
 
 
 # ---------------------------------------------------------------------------
@@ -1082,195 +1511,209 @@ def delete_question(question_id):
 # ---------------------------------------------------------------------------
 
 def get_deployment(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM deployments WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM deployments WHERE user_id=?", (user_id,))
+        return c.fetchone()
 
 
 def get_all_active_ports():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT port FROM deployments WHERE status='running'")
-    rows = c.fetchall()
-    conn.close()
-    return [r["port"] for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT port FROM deployments WHERE status='running'")
+        rows = c.fetchall()
+        return [r["port"] for r in rows]
 
 
 def stop_deployment_record(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE deployments SET status='stopped', updated_at=? WHERE user_id=?",
-              (datetime.now().isoformat(), user_id))
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute("UPDATE deployments SET status='stopped', updated_at=? WHERE user_id=?",
+                      (_now(), user_id))
+
+
+_SQL_RUNNING_DEPLOYMENTS = "SELECT user_id, pid FROM deployments WHERE status='running'"
+
+
+def _live_pids():
+    """Every live PID from a single /proc listing, or None without procfs."""
+    try:
+        return {int(p) for p in os.listdir("/proc") if p.isdigit()}
+    except OSError:
+        return None
+
+
+def _pid_alive(pid, live):
+    if live is not None:
+        return pid in live
+    if os.name == "nt":
+        return False  # os.kill would signal the process on Windows
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+# A variable-length id list as one bound JSON array: `IN (?,?,...)` would be
+# a new SQL text, and a new statement-cache entry, for every list length.
+_SQL_ID_LIST = "SELECT value FROM json_each(?)"
+
+
+def _id_list(ids):
+    return _json_dumps(list(ids))
 
 
 def cleanup_zombies():
-    """Called at startup to mark stale deployments as stopped."""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("UPDATE deployments SET status='stopped' WHERE status='running'")
-    conn.commit()
-    conn.close()
+    """Called at startup to mark deployments whose process has exited as stopped."""
+    # app.py runs this on every rerun: read first so the common case (nothing
+    # running) never takes the write lock.
+    with get_conn() as conn:
+        rows = conn.execute(_SQL_RUNNING_DEPLOYMENTS).fetchall()
+        live = _live_pids() if rows else None
+        dead = [r["user_id"] for r in rows if not r["pid"] or not _pid_alive(r["pid"], live)]
+        if dead:
+            with conn:
+                conn.execute(
+                    f"UPDATE deployments SET status='stopped', updated_at=? WHERE user_id IN ({_SQL_ID_LIST})",
+                    (_now(), _id_list(dead))
+                )
 
 
 # ---------------------------------------------------------------------------
 # Chat Logs & Analytics
 # ---------------------------------------------------------------------------
 
+_SQL_LOG_MESSAGE = (
+    "INSERT INTO chat_logs (user_id, session_id, model_id, role, content, token_estimate, created_at) "
+    "VALUES (?,?,?,?,?,?,?)"
+)
+
+
 def log_message(user_id, session_id, model_id, role, content):
     token_estimate = int(len(content.split()) * 1.3)
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO chat_logs (user_id, session_id, model_id, role, content, token_estimate, created_at) "
-        "VALUES (?,?,?,?,?,?,?)",
-        (user_id, session_id, model_id, role, content, token_estimate, datetime.now().isoformat())
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        c = conn.cursor()
+        with conn:
+            c.execute(_SQL_LOG_MESSAGE, (user_id, session_id, model_id, role, content, token_estimate, _now()))
 
 
 def get_chat_logs_for_student(user_id, limit=200):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT * FROM chat_logs WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
-        (user_id, limit)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT * FROM chat_logs WHERE user_id=? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit)
+        )
+        return c.fetchall()
 
 
 def get_chat_logs_for_class(class_id, limit=1000):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT cl.* FROM chat_logs cl "
-        "JOIN class_students cs ON cl.user_id=cs.student_id "
-        "WHERE cs.class_id=? ORDER BY cl.created_at DESC LIMIT ?",
-        (class_id, limit)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT cl.* FROM chat_logs cl "
+            "JOIN class_students cs ON cl.user_id=cs.student_id "
+            "WHERE cs.class_id=? ORDER BY cl.created_at DESC LIMIT ?",
+            (class_id, limit)
+        )
+        return c.fetchall()
 
 
 def get_analytics_daily_counts(user_ids, days=14):
     from datetime import timedelta
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
-    if user_ids:
-        placeholders = ",".join("?" * len(user_ids))
-        c.execute(
-            f"SELECT DATE(created_at) as day, COUNT(*) as messages, "
-            f"COALESCE(SUM(token_estimate),0) as tokens "
-            f"FROM chat_logs WHERE role='user' AND user_id IN ({placeholders}) "
-            f"AND created_at >= ? GROUP BY DATE(created_at) ORDER BY day",
-            tuple(user_ids) + (cutoff,)
-        )
-    else:
-        c.execute(
-            "SELECT DATE(created_at) as day, COUNT(*) as messages, "
-            "COALESCE(SUM(token_estimate),0) as tokens "
-            "FROM chat_logs WHERE role='user' AND created_at >= ? "
-            "GROUP BY DATE(created_at) ORDER BY day",
-            (cutoff,)
-        )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        if user_ids:
+            c.execute(
+                f"SELECT DATE(created_at) as day, COUNT(*) as messages, "
+                f"COALESCE(SUM(token_estimate),0) as tokens "
+                f"FROM chat_logs WHERE role='user' AND user_id IN ({_SQL_ID_LIST}) "
+                f"AND created_at >= ? GROUP BY DATE(created_at) ORDER BY day",
+                (_id_list(user_ids), cutoff)
+            )
+        else:
+            c.execute(
+                "SELECT DATE(created_at) as day, COUNT(*) as messages, "
+                "COALESCE(SUM(token_estimate),0) as tokens "
+                "FROM chat_logs WHERE role='user' AND created_at >= ? "
+                "GROUP BY DATE(created_at) ORDER BY day",
+                (cutoff,)
+            )
+        return c.fetchall()
 
 
 def get_analytics_per_student(class_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT u.username, COUNT(cl.id) as messages, "
-        "COALESCE(SUM(cl.token_estimate),0) as tokens "
-        "FROM users u "
-        "JOIN class_students cs ON u.id=cs.student_id "
-        "LEFT JOIN chat_logs cl ON u.id=cl.user_id AND cl.role='user' "
-        "WHERE cs.class_id=? GROUP BY u.id ORDER BY messages DESC",
-        (class_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT u.username, COUNT(cl.id) as messages, "
+            "COALESCE(SUM(cl.token_estimate),0) as tokens "
+            "FROM users u "
+            "JOIN class_students cs ON u.id=cs.student_id "
+            "LEFT JOIN chat_logs cl ON u.id=cl.user_id AND cl.role='user' "
+            "WHERE cs.class_id=? GROUP BY u.id ORDER BY messages DESC",
+            (class_id,)
+        )
+        return c.fetchall()
 
 
 def get_analytics_top_words(user_ids, limit=20):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    if user_ids:
-        placeholders = ",".join("?" * len(user_ids))
-        c.execute(
-            f"SELECT content FROM chat_logs WHERE role='user' AND user_id IN ({placeholders})",
-            tuple(user_ids)
-        )
-    else:
-        c.execute("SELECT content FROM chat_logs WHERE role='user'")
-    rows = c.fetchall()
-    conn.close()
-    stop = {"the", "a", "an", "is", "in", "it", "of", "to", "and", "or", "for", "with",
-            "this", "that", "what", "how", "why", "can", "i", "my", "me", "do", "does",
-            "did", "be", "are", "was", "were", "please", "help", "have", "has", "had",
-            "will", "would", "could", "should", "if", "so", "about", "from", "on", "at",
-            "by", "we", "you", "they", "he", "she", "not", "but", "get"}
-    freq = {}
-    for (text,) in rows:
-        for w in re.findall(r"[a-zA-Z]{3,}", text.lower()):
-            if w not in stop:
-                freq[w] = freq.get(w, 0) + 1
-    return sorted(freq.items(), key=lambda x: x[1], reverse=True)[:limit]
+    with get_conn() as conn:
+        c = conn.cursor()
+        if user_ids:
+            c.execute(
+                f"SELECT content FROM chat_logs WHERE role='user' AND user_id IN ({_SQL_ID_LIST})",
+                (_id_list(user_ids),)
+            )
+        else:
+            c.execute("SELECT content FROM chat_logs WHERE role='user'")
+        rows = c.fetchall()
+        stop = {"the", "a", "an", "is", "in", "it", "of", "to", "and", "or", "for", "with",
+                "this", "that", "what", "how", "why", "can", "i", "my", "me", "do", "does",
+                "did", "be", "are", "was", "were", "please", "help", "have", "has", "had",
+                "will", "would", "could", "should", "if", "so", "about", "from", "on", "at",
+                "by", "we", "you", "they", "he", "she", "not", "but", "get"}
+        freq = {}
+        for r in rows:
+            for w in re.findall(r"[a-zA-Z]{3,}", r["content"].lower()):
+                if w not in stop:
+                    freq[w] = freq.get(w, 0) + 1
+        return sorted(freq.items(), key=lambda x: x[1], reverse=True)[:limit]
 
 
 def get_analytics_totals(user_ids):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    if user_ids:
-        placeholders = ",".join("?" * len(user_ids))
-        c.execute(
-            f"SELECT COUNT(*) as messages, COALESCE(SUM(token_estimate),0) as tokens, "
-            f"COUNT(DISTINCT session_id) as sessions FROM chat_logs "
-            f"WHERE role='user' AND user_id IN ({placeholders})",
-            tuple(user_ids)
-        )
-    else:
-        c.execute(
-            "SELECT COUNT(*) as messages, COALESCE(SUM(token_estimate),0) as tokens, "
-            "COUNT(DISTINCT session_id) as sessions FROM chat_logs WHERE role='user'"
-        )
-    row = c.fetchone()
-    conn.close()
-    return dict(row) if row else {"messages": 0, "tokens": 0, "sessions": 0}
+    with get_conn() as conn:
+        c = conn.cursor()
+        if user_ids:
+            c.execute(
+                f"SELECT COUNT(*) as messages, COALESCE(SUM(token_estimate),0) as tokens, "
+                f"COUNT(DISTINCT session_id) as sessions FROM chat_logs "
+                f"WHERE role='user' AND user_id IN ({_SQL_ID_LIST})",
+                (_id_list(user_ids),)
+            )
+        else:
+            c.execute(
+                "SELECT COUNT(*) as messages, COALESCE(SUM(token_estimate),0) as tokens, "
+                "COUNT(DISTINCT session_id) as sessions FROM chat_logs WHERE role='user'"
+            )
+        return c.fetchone() or {"messages": 0, "tokens": 0, "sessions": 0}
 
 
 def get_sessions_for_student(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute(
-        "SELECT session_id, MIN(created_at) as started_at, COUNT(*) as msg_count, "
-        "MAX(CASE WHEN role='user' THEN content ELSE '' END) as last_user_msg "
-        "FROM chat_logs WHERE user_id=? GROUP BY session_id ORDER BY started_at DESC",
-        (user_id,)
-    )
-    rows = c.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT session_id, MIN(created_at) as started_at, COUNT(*) as msg_count, "
+            "MAX(CASE WHEN role='user' THEN content ELSE '' END) as last_user_msg "
+            "FROM chat_logs WHERE user_id=? GROUP BY session_id ORDER BY started_at DESC",
+            (user_id,)
+        )
+        return c.fetchall()
 
 
 # ---------------------------------------------------------------------------
@@ -3,8 +3,8 @@ rag_utils.py — Page-based document indexing and retrieval.
 
 Inspired by PageIndex (vectorless RAG):
   - Documents are indexed page by page, storing text and a short LLM-generated summary.
-  - Retrieval ranks pages by keyword overlap against the user query, then prepends the
-    top-N pages as context to the LLM prompt.
+  - Retrieval ranks pages by BM25 over an inverted index of page tokens, then prepends
+    the top-N pages as context to the LLM prompt.
   - No vector database or local embedding model required.
 """
 
@@ -12,9 +12,27 @@ import os
 import json
 import re
 import math
+import hashlib
+import heapq
+import mmap
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# Optional orjson: several times faster than json for large indexes
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 DOCS_DIR = os.path.join("data", "system", "docs")
+# Concurrent page-summary requests per document; lower it if the model's
+# endpoint rate-limits.
+SUMMARY_WORKERS = int(os.environ.get("RAG_SUMMARY_WORKERS", "8"))
+# Page text injected into a prompt is capped at this; the index stores no more.
+MAX_CHARS_PER_PAGE_DEFAULT = 1500
 
 
 def _ensure_docs_dir():
@@ -26,17 +44,18 @@ def _ensure_docs_dir():
 # ---------------------------------------------------------------------------
 
 def extract_pages_from_pdf(file_path):
-    """Return list of {page_num, text} dicts (1-indexed)."""
+    """Yield {page_num, text} dicts (1-indexed) one page at a time, so large
+    PDFs are indexed as they are read instead of held in memory first."""
+    done = 0
     try:
         import pypdf
         reader = pypdf.PdfReader(file_path)
-        pages = []
-        for i, page in enumerate(reader.pages):
+        for page in reader.pages:
             text = page.extract_text() or ""
-            pages.append({"page_num": i + 1, "text": text.strip()})
-        return pages
+            yield {"page_num": done + 1, "text": text.strip()}
+            done += 1
     except Exception as e:
-        return [{"page_num": 1, "text": f"[PDF extraction error: {e}]"}]
+        yield {"page_num": done + 1, "text": f"[PDF extraction error: {e}]"}
 
 
 def extract_pages_from_docx(file_path):
@@ -63,7 +82,7 @@ def extract_pages_from_image(file_path):
 
 
 def extract_pages(file_path, file_type):
-    """Dispatch extraction based on file type."""
+    """Dispatch extraction based on file type. Returns an iterable of pages."""
     ft = file_type.lower()
     if ft == "pdf":
         return extract_pages_from_pdf(file_path)
@@ -86,20 +105,53 @@ def extract_pages(file_path, file_type):
 # Index building
 # ---------------------------------------------------------------------------
 
+# Han, kana and Hangul characters are single tokens (these scripts don't
+# separate words with spaces, so "中國" must match a page with "中" or "國");
+# any other run of Unicode letters/digits is one token.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(f"[{_CJK}]|[^\\W_{_CJK}]+")
+# Stored in each index; postings from another tokenizer or layout are rebuilt.
+INDEX_VERSION = 4
+
+
 def _tokenize(text):
-    return re.findall(r"[a-z\u4e00-\u9fff0-9]+", text.lower())
+    return _TOKEN_RE.findall(text.casefold())
+
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def _add_postings(postings, page_idx, tokens):
+    """Add one page to an inverted index {token: [page_idx, tf, page_idx, tf, ...]}."""
+    # Flat lists rather than [page_idx, tf] pairs: one list per token instead
+    # of one per posting, several times less memory and JSON to parse.
+    for tok, tf in Counter(tokens).items():
+        postings.setdefault(tok, []).extend((page_idx, tf))
+
 
+def _build_postings(page_tokens):
+    """Inverted index plus per-page lengths for a list of token lists."""
+    postings = {}
+    for i, tokens in enumerate(page_tokens):
+        _add_postings(postings, i, tokens)
+    return postings, [len(tokens) for tokens in page_tokens]
 
-def _tf_idf_score(query_tokens, page_tokens, idf):
-    score = 0.0
-    page_len = len(page_tokens) or 1
-    tf_map = {}
-    for tok in page_tokens:
-        tf_map[tok] = tf_map.get(tok, 0) + 1
-    for qt in query_tokens:
-        tf = tf_map.get(qt, 0) / page_len
-        score += tf * idf.get(qt, 1.0)
-    return score
+
+def _bm25_norms(page_lens):
+    """Per-page BM25 length normalisation k1 * (1 - b + b * len / avgdl)."""
+    avgdl = (sum(page_lens) / len(page_lens) if page_lens else 0.0) or 1.0
+    return [BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl) for length in page_lens]
+
+
+def _bm25_idf(postings, n):
+    """BM25 IDF; a token's posting list has one (page_idx, tf) per page containing it."""
+    idf = {}
+    for tok, pl in postings.items():
+        df = len(pl) // 2
+        idf[tok] = math.log((n - df + 0.5) / (df + 0.5) + 1)
+    return idf
 
 
 def build_page_index(file_path, file_type, model=None):
@@ -111,56 +163,105 @@ def build_page_index(file_path, file_type, model=None):
         "file_path": ...,
         "file_type": ...,
         "created_at": ...,
-        "pages": [{"page_num": 1, "text": "...", "summary": "...", "tokens": [...]}]
+        "idf": {token: idf},
+        "postings": {token: [page_idx, tf, page_idx, tf, ...]},
+        "page_lens": [...],
+        "avgdl": ...,
+        "page_norms": [...],
+        "pages": [{"page_num": 1, "text": "...", "summary": "..."}]
     }
 
     If model is provided (dict with OpenAI-compatible fields), an LLM summary is
     generated for each page.  Otherwise, only the first 300 chars are stored.
     """
-    pages = extract_pages(file_path, file_type)
-    indexed_pages = []
-    for p in pages:
-        tokens = _tokenize(p["text"])
-        summary = p["text"][:300].replace("\n", " ") + ("..." if len(p["text"]) > 300 else "")
-        if model and p.get("text") and not p.get("is_image"):
+    # One pass over the pages: each is tokenized into the postings (its token
+    # list is then dropped) and, with a model, its summary request is queued
+    # while later pages are still being extracted.
+    indexed_pages, postings, page_lens, futures = [], {}, [], {}
+    ex = _summary_pool() if model else None
+    try:
+        for i, p in enumerate(extract_pages(file_path, file_type)):
+            tokens = _tokenize(p["text"])
+            _add_postings(postings, i, tokens)
+            page_lens.append(len(tokens))
+            if ex and p.get("text") and not p.get("is_image"):
+                futures[i] = ex.submit(_llm_summarize_page, model, p["text"])
+            indexed_pages.append({
+                "page_num": p["page_num"],
+                # tokens above come from the full page; only the part
+                # retrieval can return is kept
+                "text": p["text"][:MAX_CHARS_PER_PAGE_DEFAULT],
+                "summary": None,
+                "is_image": p.get("is_image", False),
+            })
+    except BaseException:
+        for f in futures.values():
+            f.cancel()
+        raise
+
+    for i, p in enumerate(indexed_pages):
+        if i in futures:
             try:
-                summary = _llm_summarize_page(model, p["text"])
+                p["summary"] = futures[i].result()
             except Exception:
                 pass
-        indexed_pages.append({
-            "page_num": p["page_num"],
-            "text": p["text"],
-            "summary": summary,
-            "tokens": tokens,
-            "is_image": p.get("is_image", False),
-        })
-
-    # Compute IDF over all pages
-    doc_freq = {}
-    for p in indexed_pages:
-        for tok in set(p["tokens"]):
-            doc_freq[tok] = doc_freq.get(tok, 0) + 1
-    n = len(indexed_pages) or 1
-    idf = {tok: math.log(n / df + 1) for tok, df in doc_freq.items()}
+        if p["summary"] is None:
+            p["summary"] = p["text"][:300].replace("\n", " ") + ("..." if len(p["text"]) > 300 else "")
+    n = len(indexed_pages)
 
     return {
         "file_path": file_path,
         "file_type": file_type,
         "created_at": datetime.now().isoformat(),
         "page_count": len(indexed_pages),
-        "idf": idf,
+        "index_version": INDEX_VERSION,
+        "idf": _bm25_idf(postings, n),
+        "postings": postings,
+        "page_lens": page_lens,
+        "avgdl": (sum(page_lens) / n) if n else 0.0,
+        "page_norms": _bm25_norms(page_lens),
         "pages": indexed_pages,
     }
 
 
+# One OpenAI client per (api_url, api_key): each owns an HTTP connection pool,
+# so summary requests for consecutive pages reuse open TLS connections.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Summary requests from every build share one pool, so indexing several
+# documents neither spins up threads per build nor multiplies the load on
+# the model server.
+_summary_executor = None
+_summary_executor_lock = threading.Lock()
+
+
+def _summary_pool():
+    global _summary_executor
+    if _summary_executor is None:
+        with _summary_executor_lock:
+            if _summary_executor is None:
+                _summary_executor = ThreadPoolExecutor(max_workers=max(1, SUMMARY_WORKERS),
+                                                       thread_name_prefix="rag-summary")
+    return _summary_executor
+
+
+def _client_for(model):
+    key = (model["api_url"], model.get("api_key") or "")
+    client = _clients.get(key)
+    if client is None:
+        from openai import OpenAI
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = OpenAI(api_key=key[1] or "not-required", base_url=key[0])
+    return client
+
+
 def _llm_summarize_page(model, text):
     """Call the teacher-configured model to summarize a page."""
-    from openai import OpenAI
-    client = OpenAI(
-        api_key=model.get("api_key") or "not-required",
-        base_url=model["api_url"]
-    )
-    resp = client.chat.completions.create(
+    resp = _client_for(model).chat.completions.create(
         model=model.get("model_name") or "gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": "Summarize the following page content in 1-2 sentences for use as a search index. Be concise."},
@@ -176,59 +277,240 @@ def _llm_summarize_page(model, text):
 # Index persistence
 # ---------------------------------------------------------------------------
 
+# An index is saved as a JSON header (postings, IDF, per-page summary and the
+# byte offset/length of its text) plus index_<id>.pages.bin holding the page
+# texts back to back. Retrieval scores from the header alone and then reads
+# only the top pages' text from the .pages.bin file.
+
 def save_index(doc_id, index):
     """Save index JSON next to the document. Returns the path."""
     _ensure_docs_dir()
-    path = os.path.join(DOCS_DIR, f"index_{doc_id}.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(index, f, ensure_ascii=False, indent=2)
+    base = os.path.join(DOCS_DIR, f"index_{doc_id}")
+    path = base + ".json"
+    blob = bytearray()
+    header_pages = []
+    for p in index["pages"]:
+        data = p.get("text", "").encode("utf-8")
+        page = {k: v for k, v in p.items() if k != "text"}
+        page["offset"], page["length"] = len(blob), len(data)
+        header_pages.append(page)
+        blob += data
+    # Texts first, so a header never points at a missing pages file
+    with open(base + ".pages.bin", "wb") as f:
+        f.write(blob)
+    _write_json(path, {**index, "pages": header_pages, "pages_file": os.path.basename(base) + ".pages.bin"})
+    if index.get("content_hash"):
+        _record_in_manifest(index["content_hash"], path)
     return path
 
 
-def load_index(index_path):
-    """Load a previously saved index JSON."""
+def load_index(index_path, with_text=True):
+    """Load a previously saved index. with_text=False returns the header only;
+    page texts are then read with _page_texts."""
     try:
-        with open(index_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        index = _read_json(index_path)
+        if with_text and index.get("pages_file"):
+            with open(_pages_path(index_path, index), "rb") as f:
+                blob = f.read()
+            for p in index["pages"]:
+                p["text"] = blob[p["offset"]:p["offset"] + p["length"]].decode("utf-8")
+        return index
     except Exception:
         return None
 
 
+# Parsed headers of saved indexes, checked against the file's mtime and size,
+# so a chat turn doesn't re-read and re-parse the postings from disk.
+_HEADER_CACHE_MAX = 32
+_header_cache = {}
+_header_cache_lock = threading.Lock()
+
+
+def _cached_header(index_path):
+    """load_index(index_path, with_text=False), reused while the file is
+    unchanged. Callers must not mutate the result."""
+    try:
+        st = os.stat(index_path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    hit = _header_cache.get(index_path)
+    if hit and hit[0] == key:
+        return hit[1]
+    index = load_index(index_path, with_text=False)
+    if index is not None:
+        with _header_cache_lock:
+            if index_path not in _header_cache and len(_header_cache) >= _HEADER_CACHE_MAX:
+                _header_cache.pop(next(iter(_header_cache)), None)
+            _header_cache[index_path] = (key, index)
+    return index
+
+
+def delete_index(index_path):
+    """Remove a saved index and its pages file."""
+    with _header_cache_lock:
+        _header_cache.pop(index_path, None)
+    index = load_index(index_path, with_text=False)
+    paths = [index_path]
+    if index and index.get("pages_file"):
+        paths.append(_pages_path(index_path, index))
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _pages_path(index_path, index):
+    return os.path.join(os.path.dirname(index_path), index["pages_file"])
+
+
+def _page_texts(index, pages, index_path=None):
+    """Text of the given pages: inline for in-memory and older indexes,
+    otherwise sliced out of the memory-mapped pages file."""
+    if all("text" in p for p in pages):
+        return [p["text"] for p in pages]
+    with open(_pages_path(index_path, index), "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ["" for _ in pages]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return [p["text"] if "text" in p else
+                    mm[p["offset"]:p["offset"] + p["length"]].decode("utf-8") for p in pages]
+
+
+def _write_json(path, data):
+    # Compact UTF-8; indentation roughly doubled index files.
+    if HAS_ORJSON:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def _read_json(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    return orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+
+
+# ---------------------------------------------------------------------------
+# Content-hash manifest: re-uploads of an unchanged file reuse its index
+# ---------------------------------------------------------------------------
+
+_manifest_lock = threading.Lock()
+
+
+def _manifest_path():
+    return os.path.join(DOCS_DIR, "manifest.json")
+
+
+def _file_hash(file_path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _load_manifest():
+    try:
+        with open(_manifest_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_in_manifest(content_hash, index_path):
+    with _manifest_lock:
+        manifest = _load_manifest()
+        manifest[content_hash] = index_path
+        tmp = _manifest_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, _manifest_path())
+
+
+def build_or_load_page_index(file_path, file_type, model=None):
+    """build_page_index, unless a saved index exists for a file with the same bytes."""
+    try:
+        content_hash = _file_hash(file_path)
+    except OSError:
+        return build_page_index(file_path, file_type, model)
+    summary_model = model.get("model_name") if model else None
+    cached_path = _load_manifest().get(content_hash)
+    index = load_index(cached_path) if cached_path else None
+    if (index and index.get("content_hash") == content_hash
+            and index.get("index_version") == INDEX_VERSION
+            and index.get("summary_model") == summary_model):
+        index["file_path"], index["file_type"] = file_path, file_type
+        return index
+    index = build_page_index(file_path, file_type, model)
+    index["content_hash"] = content_hash
+    index["summary_model"] = summary_model
+    return index
+
+
 # ---------------------------------------------------------------------------
 # Retrieval
 # ---------------------------------------------------------------------------
 
-def retrieve_context(index_or_path, query, top_n=4, max_chars_per_page=1500):
+def retrieve_context(index_or_path, query, top_n=4, max_chars_per_page=MAX_CHARS_PER_PAGE_DEFAULT,
+                     query_tokens=None):
     """
     Given a page index (dict or path to JSON) and a query string, return a
     formatted string of the most relevant pages to inject as RAG context.
+    query_tokens, if given, is _tokenize(query) computed by the caller.
     """
-    if isinstance(index_or_path, str):
-        index = load_index(index_or_path)
-    else:
-        index = index_or_path
+    index_path = index_or_path if isinstance(index_or_path, str) else None
+    index = _cached_header(index_path) if index_path else index_or_path
 
     if not index or not index.get("pages"):
         return ""
 
-    query_tokens = _tokenize(query)
-    idf = index.get("idf", {})
-
-    scored = []
-    for p in index["pages"]:
-        tokens = p.get("tokens") or _tokenize(p.get("text", ""))
-        score = _tf_idf_score(query_tokens, tokens, idf)
-        scored.append((score, p))
-
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top_pages = [p for _, p in scored[:top_n] if _ > 0]
+    if index.get("index_version") != INDEX_VERSION and index.get("pages_file"):
+        index = load_index(index_path)  # re-tokenizing below needs the texts
+        if not index:
+            return ""
+    pages = index["pages"]
+    if index.get("index_version") != INDEX_VERSION:
+        # Indexes saved by an older version: re-tokenize the stored text
+        postings, page_lens = _build_postings([_tokenize(p.get("text", "")) for p in pages])
+        idf = _bm25_idf(postings, len(pages))
+        norms = _bm25_norms(page_lens)
+    else:
+        postings, idf, norms = index["postings"], index["idf"], index["page_norms"]
+
+    # Only pages containing a query token are ever scored. Everything that
+    # doesn't depend on the posting (IDF, k1 + 1, the page's length
+    # normalisation) is computed once per token or stored in the index.
+    scores = defaultdict(float)
+    if query_tokens is None:
+        query_tokens = _tokenize(query)
+    for qt in set(query_tokens):
+        pl = postings.get(qt)
+        if not pl:
+            continue
+        w = idf.get(qt, 0.0) * (BM25_K1 + 1)
+        for i, tf in zip(pl[::2], pl[1::2]):
+            scores[i] += w * tf / (tf + norms[i])
+
+    # Only the top_n are needed: O(P log N) instead of sorting every match
+    ranked = heapq.nlargest(top_n, scores.items(), key=lambda x: x[1])
+    top_pages = [pages[i] for i, s in ranked if s > 0]
 
     if not top_pages:
-        top_pages = [p for _, p in scored[:2]]
+        top_pages = pages[:2]
 
+    top_pages = sorted(top_pages, key=lambda x: x["page_num"])
     chunks = []
-    for p in sorted(top_pages, key=lambda x: x["page_num"]):
-        text = p.get("text", "")[:max_chars_per_page]
-        chunks.append(f"[Page {p['page_num']}]\n{text}")
+    for p, text in zip(top_pages, _page_texts(index, top_pages, index_path)):
+        chunks.append(f"[Page {p['page_num']}]\n{text[:max_chars_per_page]}")
 
     return "\n\n---\n\n".join(chunks)
+
+
+def retrieve_context_many(indexes_or_paths, query, **kwargs):
+    """retrieve_context for several indexes, tokenizing the query once."""
+    query_tokens = _tokenize(query)
+    return [retrieve_context(i, query, query_tokens=query_tokens, **kwargs) for i in indexes_or_paths]
@@ -2,26 +2,69 @@ import streamlit as st
 import sys
 import os
 import json
+import re
+import base64
+import hashlib
 import requests
 import uuid
 import socket
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import database
 import rag_utils
 from openai import OpenAI
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 # ---- OpenAI-compatible model API helpers ----
 
+@st.cache_resource(show_spinner=False)
+def model_client(api_url, api_key):
+    """One OpenAI client (and its connection pool) per backend and key,
+    reused across calls and reruns."""
+    return OpenAI(api_key=api_key or "not-required", base_url=api_url)
+
 def call_model_api(model, messages):
     """
     Multi-turn chat call.
     model: dict with api_url, api_key, model_name, system_prompt, override_prompt (optional)
     messages: list of {"role": ..., "content": ...}
     """
-    client = OpenAI(
-        api_key=model.get("api_key") or "not-required",
-        base_url=model["api_url"]
-    )
+    client = model_client(model["api_url"], model.get("api_key"))
+    try:
+        resp = client.chat.completions.create(
+            model=model.get("model_name") or "gpt-3.5-turbo",
+            messages=_build_messages(model, messages),
+        )
+        return resp.choices[0].message.content
+    except Exception as e:
+        return f"[Model Error]: {e}"
+
+
+def stream_model_api(model, messages, image_b64=None):
+    """Like call_model_api, but yields text chunks for st.write_stream. An
+    attached image rides along on the last user turn of the same request."""
+    client = model_client(model["api_url"], model.get("api_key"))
+    try:
+        stream = client.chat.completions.create(
+            model=model.get("model_name") or "gpt-3.5-turbo",
+            messages=_build_messages(model, messages, image_b64),
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        yield f"[Model Error]: {e}"
+
+
+def _build_messages(model, messages, image_b64=None):
+    """System prompt (model prompt + teacher override) followed by the history,
+    with the image (if any) on the last user turn."""
     system_parts = []
     if model.get("system_prompt"):
         system_parts.append(model["system_prompt"])
@@ -31,14 +74,13 @@ def call_model_api(model, messages):
     if system_parts:
         full_messages.append({"role": "system", "content": "\n\n".join(system_parts)})
     full_messages.extend(messages)
-    try:
-        resp = client.chat.completions.create(
-            model=model.get("model_name") or "gpt-3.5-turbo",
-            messages=full_messages,
-        )
-        return resp.choices[0].message.content
-    except Exception as e:
-        return f"[Model Error]: {e}"
+    # A new dict, so the caller's history is never mutated
+    if image_b64 and full_messages and full_messages[-1]["role"] == "user":
+        full_messages[-1] = {"role": "user", "content": [
+            {"type": "text", "text": full_messages[-1]["content"]},
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
+        ]}
+    return full_messages
 
 
 def call_model_api_single(model, prompt):
@@ -47,10 +89,19 @@ def call_model_api_single(model, prompt):
 
 # --- Constants ---
 DATA_DIR = "data"
+# Messages sent to the model per turn: the new question plus the last 8
+# exchanges. Odd, so the window always starts on a user message.
+CHAT_CONTEXT_WINDOW = 17
 
+@st.cache_resource(show_spinner=False)
 def get_local_ip():
+    """Resolved once per process, on first use rather than on every rerun.
+    SERVER_IP, when set, skips the socket probe entirely."""
+    if os.environ.get("SERVER_IP"):
+        return os.environ["SERVER_IP"]
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(0.5)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
@@ -58,55 +109,224 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
-SERVER_IP = get_local_ip()
-DEFAULT_OLLAMA_URL = f"http://{SERVER_IP}:11434"
-DEFAULT_ANY_LLM_URL = f"http://{SERVER_IP}:3001/api/v1"
+def default_ollama_url():
+    return f"http://{get_local_ip()}:11434"
+
+def default_any_llm_url():
+    return f"http://{get_local_ip()}:3001/api/v1"
 
 # --- Helper Functions ---
 def get_user_dir(username):
     return os.path.join(DATA_DIR, username)
 
+def _dumps(data):
+    """Compact UTF-8 JSON bytes, via orjson when installed."""
+    if HAS_ORJSON:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _loads(raw):
+    return orjson.loads(raw) if HAS_ORJSON else json.loads(raw)
+
+def _write_json(path, data):
+    """The payload goes out in one write to a temp file that then replaces
+    path, so readers never see a torn file."""
+    payload = _dumps(data)
+    tmp = path + ".tmp"
+    try:
+        f = open(tmp, "wb")
+    except FileNotFoundError:
+        # First write for this user: create the directory only then.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(tmp, "wb")
+    with f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+def _read_json(path):
+    with open(path, "rb") as f:
+        return _loads(f.read())
+
 def load_config(username):
-    config_file = os.path.join(get_user_dir(username), "config.json")
-    if os.path.exists(config_file):
-        try:
-            with open(config_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except:
-            pass
-    return {}
+    try:
+        return _read_json(os.path.join(get_user_dir(username), "config.json"))
+    except:
+        return {}
 
-def load_session(username, session_id):
+def save_config(username, config):
+    _write_json(os.path.join(get_user_dir(username), "config.json"), config)
+
+# A session is a JSON snapshot ({id}.json) plus an append-only tail of the
+# messages added since that snapshot ({id}.jsonl), as in app.py. Each chat turn
+# only appends to the tail; flush_session folds it back into the snapshot.
+
+def _session_paths(username, session_id):
     history_dir = os.path.join(get_user_dir(username), "history")
-    file_path = os.path.join(history_dir, f"{session_id}.json")
+    return (os.path.join(history_dir, f"{session_id}.json"),
+            os.path.join(history_dir, f"{session_id}.jsonl"))
+
+def load_session(username, session_id):
+    json_path, log_path = _session_paths(username, session_id)
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("messages", []), data.get("title", "New Chat")
+        data = _read_json(json_path)
     except:
         return [], "New Chat"
+    msgs = data.get("messages", [])
+    try:
+        with open(log_path, "rb") as f:
+            for line in f:
+                try: msgs.append(_loads(line))
+                except ValueError: pass  # torn final line from an interrupted append
+    except FileNotFoundError:
+        pass
+    return msgs, data.get("title", "New Chat")
+
+_TITLE_RE = re.compile(r'"title"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def session_title(file_path, mtime):
+    """Title of a saved chat for the sidebar; mtime only keys the cache.
+    save_session writes the title before the messages, so the first 512
+    bytes usually hold it and the rest of the file is never parsed."""
+    try:
+        with open(file_path, "rb") as f:
+            head = f.read(512).decode("utf-8", errors="ignore")
+        m = _TITLE_RE.search(head)
+        if m:
+            return json.loads(m.group(1))
+        return _read_json(file_path).get("title", "Untitled Chat")
+    except Exception:
+        return "Corrupted"
+
+# The sidebar index lives outside the *.json session namespace, which app.py
+# lists as chats. app.py deletes it whenever it changes a session, and it is
+# then rebuilt here from the files.
+HISTORY_INDEX_NAME = ".index"
+_LEGACY_INDEX_NAME = "_index.json"
+
+def _history_index_path(username):
+    return os.path.join(get_user_dir(username), "history", HISTORY_INDEX_NAME)
+
+def _history_index_mtime(username):
+    try:
+        return os.stat(_history_index_path(username)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def load_history_index(username):
+    """session_id -> {"title", "updated_at"} for the sidebar, from one file.
+    Rebuilt from the session files when missing (e.g. older history dirs)."""
+    path = _history_index_path(username)
+    try:
+        return _read_json(path)
+    except Exception:
+        pass  # missing or corrupt: rebuild below
+    history_dir = os.path.dirname(path)
+    snapshots, mtimes = {}, {}
+    try:
+        with os.scandir(history_dir) as it:
+            for e in it:
+                sid, ext = os.path.splitext(e.name)
+                if ext not in (".json", ".jsonl") or e.name == _LEGACY_INDEX_NAME:
+                    continue
+                mtime = e.stat().st_mtime
+                # a chat's last activity may be in its appended tail
+                mtimes[sid] = max(mtime, mtimes.get(sid, 0))
+                if ext == ".json":
+                    snapshots[sid] = (e.path, mtime)
+    except FileNotFoundError:
+        return {}
+    try:
+        os.remove(os.path.join(history_dir, _LEGACY_INDEX_NAME))
+    except FileNotFoundError:
+        pass
+    index = {
+        sid: {"title": session_title(fpath, mtime),
+              "updated_at": datetime.fromtimestamp(mtimes[sid]).isoformat()}
+        for sid, (fpath, mtime) in snapshots.items()
+    }
+    if index:
+        _write_json(path, index)
+    return index
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def sorted_history(username, index_mtime):
+    """Sidebar rows (session_id, meta), newest first; index_mtime only keys
+    the cache, so reruns that saved nothing skip the read and sort."""
+    return sorted(load_history_index(username).items(),
+                  key=lambda kv: kv[1].get("updated_at", ""), reverse=True)
+
+def _update_history_index(username, session_id, entry=None):
+    """Set (or, with entry=None, drop) one session in the sidebar index."""
+    index = load_history_index(username)
+    if entry is None:
+        if index.pop(session_id, None) is None:
+            return
+    else:
+        index[session_id] = entry
+    _write_json(_history_index_path(username), index)
 
 def delete_session(username, session_id):
-    history_dir = os.path.join(get_user_dir(username), "history")
-    file_path = os.path.join(history_dir, f"{session_id}.json")
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        return True
-    return False
+    json_path, log_path = _session_paths(username, session_id)
+    try:
+        os.remove(log_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.remove(json_path)
+    except FileNotFoundError:
+        return False
+    _update_history_index(username, session_id)
+    return True
 
 def save_image(username, image_bytes):
+    """Files are named by content, so sending the same image again reuses
+    the stored copy instead of writing it out a second time."""
     images_dir = os.path.join(get_user_dir(username), "images")
-    os.makedirs(images_dir, exist_ok=True)
-    filename = f"{uuid.uuid4()}.png"
+    filename = hashlib.blake2b(image_bytes, digest_size=16).hexdigest() + ".png"
     file_path = os.path.join(images_dir, filename)
-    with open(file_path, "wb") as f:
+    if os.path.exists(file_path):
+        return filename
+    tmp = file_path + ".part"
+    try:
+        f = open(tmp, "wb")
+    except FileNotFoundError:
+        os.makedirs(images_dir, exist_ok=True)
+        f = open(tmp, "wb")
+    with f:
         f.write(image_bytes)
+    os.replace(tmp, file_path)  # never leave a truncated file under the final name
     return filename
 
 def get_image_path(username, filename):
     return os.path.join(get_user_dir(username), "images", filename)
 
+IMAGE_CACHE_MAX = 16  # images are large; only the recently used ones stay in memory
+
+def load_image_bytes(username, filename):
+    """Bytes of a stored chat image, kept in session_state so reruns don't
+    re-read it from disk; None if the file is gone."""
+    cache = st.session_state.setdefault("_img_cache", {})
+    data = cache.pop(filename, None)
+    if data is not None:
+        cache[filename] = data  # re-insert: a hit makes it the most recent
+    else:
+        try:
+            with open(get_image_path(username, filename), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        _remember_image(filename, data)
+    return data
+
+def _remember_image(filename, data):
+    cache = st.session_state.setdefault("_img_cache", {})
+    if filename not in cache and len(cache) >= IMAGE_CACHE_MAX:
+        cache.pop(next(iter(cache)))  # least recently used first
+    cache[filename] = data
+
 def save_session(username, session_id, messages):
+    """Rewrite the full snapshot (and drop the now-redundant tail)."""
     if not messages: return
     
     title = "New Chat"
@@ -115,48 +335,106 @@ def save_session(username, session_id, messages):
             title = msg["content"][:30] + "..." if len(msg["content"]) > 30 else msg["content"]
             break
             
-    history_dir = os.path.join(get_user_dir(username), "history")
-    os.makedirs(history_dir, exist_ok=True)
-    file_path = os.path.join(history_dir, f"{session_id}.json")
+    file_path, log_path = _session_paths(username, session_id)
     
-    messages_to_save = []
-    for msg in messages:
-        msg_copy = msg.copy()
-        if "image_data" in msg_copy: 
-             del msg_copy["image_data"] # Don't save bytes to JSON
-        messages_to_save.append(msg_copy)
-        
+    # Don't save bytes to JSON; messages without them are stored as-is
+    messages_to_save = [
+        {k: v for k, v in msg.items() if k != "image_data"} if "image_data" in msg else msg
+        for msg in messages
+    ]
+
+    updated_at = datetime.now().isoformat()
     data = {
         "id": session_id,
         "title": title,
-        "updated_at": datetime.now().isoformat(),
+        "updated_at": updated_at,
         "messages": messages_to_save
     }
     
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    _write_json(file_path, data)
+    try:
+        os.remove(log_path)
+    except FileNotFoundError:
+        pass
+    _update_history_index(username, session_id, {"title": title, "updated_at": updated_at})
+
+def append_session(username, session_id, messages, n_new=2):
+    """Persist only the last `n_new` messages. The first turn of a new session
+    writes the snapshot so it shows up in the history list with its title."""
+    json_path, log_path = _session_paths(username, session_id)
+    entry = load_history_index(username).get(session_id)
+    if entry is None:  # not indexed yet, so no snapshot either
+        save_session(username, session_id, messages); return
+    payload = b"".join(
+        _dumps({k: v for k, v in m.items() if k != "image_data"} if "image_data" in m else m) + b"\n"
+        for m in messages[-n_new:]
+    )
+    with open(log_path, "ab") as f:
+        f.write(payload)
+    _update_history_index(username, session_id,
+                          {"title": entry.get("title", "New Chat"),
+                           "updated_at": datetime.now().isoformat()})
+
+def flush_session(username, session_id):
+    """Fold the appended tail back into the canonical JSON snapshot."""
+    json_path, log_path = _session_paths(username, session_id)
+    if not os.path.exists(log_path): return
+    msgs, _ = load_session(username, session_id)
+    save_session(username, session_id, msgs)
+
+def _flush_pending_session(username):
+    """Compact the current chat's appended tail before leaving it."""
+    if st.session_state.get("_pending_save") and st.session_state.get("session_id"):
+        flush_session(username, st.session_state.session_id)
+    st.session_state._pending_save = False
 
 # --- Notebook Functions (JSON Based) ---
 def get_notebook_path(username):
     return os.path.join(get_user_dir(username), "notebook.json")
 
 def load_notebook(username):
+    try:
+        return _read_json(get_notebook_path(username))
+    except:
+        return []
+
+def _notebook_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def cached_notebook(username):
+    """The parsed notebook, kept in session_state and reparsed only when the
+    file's mtime changes. Callers that mutate it must follow with save_notebook."""
     path = get_notebook_path(username)
-    if os.path.exists(path):
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return []
+    mtime = _notebook_mtime(path)
+    cache = st.session_state.get("_nb_cache")
+    if cache and cache[0] == path and cache[1] == mtime:
+        return cache[2]
+    notebook = load_notebook(username)
+    st.session_state["_nb_cache"] = (path, mtime, notebook)
+    return notebook
+
+def sorted_notebook(username):
+    """(entries newest-first, {id: label}) for the Practice and Notebook tabs,
+    rebuilt only when the notebook file changes."""
+    notebook = cached_notebook(username)
+    version = st.session_state["_nb_cache"][1]
+    cache = st.session_state.get("_nb_sorted")
+    if cache is None or cache[0] != version:
+        ordered = sorted(notebook, key=lambda x: x['timestamp'], reverse=True)
+        options = {e['id']: f"{e['title']} ({e['timestamp'][:10]})" for e in ordered}
+        cache = st.session_state["_nb_sorted"] = (version, ordered, options)
+    return cache[1], cache[2]
 
 def save_notebook(username, notebook_data):
     path = get_notebook_path(username)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(notebook_data, f, ensure_ascii=False, indent=2)
+    _write_json(path, notebook_data)
+    st.session_state["_nb_cache"] = (path, _notebook_mtime(path), notebook_data)
 
 def add_to_notebook(username, question, answer, summary=None):
-    notebook = load_notebook(username)
+    notebook = cached_notebook(username)
     entry = {
         "id": str(uuid.uuid4()),
         "timestamp": datetime.now().isoformat(),
@@ -167,35 +445,90 @@ def add_to_notebook(username, question, answer, summary=None):
     }
     notebook.append(entry)
     save_notebook(username, notebook)
+    return entry["id"]
+
+def update_notebook_entry_summary(username, entry_id, summary):
+    """Fill in a summary that arrived after the entry was added."""
+    notebook = cached_notebook(username)
+    for n in notebook:
+        if n['id'] == entry_id:
+            # Entries start out titled by their question; use the summary
+            # instead unless the student has renamed it meanwhile.
+            if n['title'] == n['question'][:50]:
+                n['title'] = summary[:50]
+            n['summary'] = summary
+            break
+    save_notebook(username, notebook)
 
 def delete_notebook_entry(username, entry_id):
-    notebook = load_notebook(username)
-    notebook = [n for n in notebook if n['id'] != entry_id]
+    notebook = [n for n in cached_notebook(username) if n['id'] != entry_id]
     save_notebook(username, notebook)
 
 def update_notebook_entry_title(username, entry_id, new_title):
-    notebook = load_notebook(username)
+    notebook = cached_notebook(username)
     for n in notebook:
         if n['id'] == entry_id:
             n['title'] = new_title
             break
     save_notebook(username, notebook)
 
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_allowed_models(user_id):
+    """Same 30s window as app.py's cache of the same name."""
+    return database.get_allowed_models_for_student(user_id)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_indexed_docs():
+    return database.get_indexed_documents()
+
+@st.cache_resource
+def background_executor():
+    """Process-wide pool for slow model calls that shouldn't block a rerun."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def _collect_pending_summaries(username):
+    """Store notebook summaries whose background call has finished."""
+    pending = st.session_state.get("pending_summaries")
+    if not pending:
+        return
+    for entry_id, fut in list(pending.items()):
+        if not fut.done():
+            continue
+        del pending[entry_id]
+        try:
+            summary = fut.result()
+        except Exception:
+            continue
+        if summary and not summary.startswith("[Model Error]"):
+            update_notebook_entry_summary(username, entry_id, summary)
+
+@st.cache_resource
+def http_session():
+    """One keep-alive connection pool for the process; runner.py itself is
+    re-executed on every rerun, so a plain module global would not survive."""
+    session = requests.Session()
+    session.headers["Content-Type"] = "application/json"  # every call posts JSON
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def call_ollama_vision(base_url, model_name, image_bytes, prompt):
     """Kept for backward compatibility — prefer call_model_api for new code."""
     url = f"{base_url}/api/generate"
-    import base64
-    img_b64 = base64.b64encode(image_bytes).decode('utf-8')
     payload = {
         "model": model_name,
         "prompt": prompt,
-        "images": [img_b64],
         "stream": False
     }
+    # Base64 output is JSON-safe ASCII, so the image bytes are spliced into the
+    # encoded body as-is rather than decoded to str and re-encoded by requests.
+    body = b"".join((_dumps(payload)[:-1], b',"images":["',
+                     base64.b64encode(image_bytes), b'"]}'))
     try:
-        response = requests.post(url, json=payload, timeout=180)
+        response = http_session().post(url, data=body, timeout=180)
         response.raise_for_status()
-        return response.json().get("response", "")
+        return _loads(response.content).get("response", "")
     except Exception as e:
         return f"[Vision Error]: {str(e)}"
 
@@ -220,10 +553,18 @@ if not user:
     st.stop()
 
 username = user["username"]
-config = load_config(username)
+_collect_pending_summaries(username)
+
+# Parsed once per browser session; the model selector edits this same dict
+# and persists it through save_config.
+if "config" not in st.session_state:
+    st.session_state.config = load_config(username)
+config = st.session_state.config
 
 # App Config
-app_title = config.get("app_title", f"{user['name']}'s AI Tutor")
+# config.json has two keys; read each once per rerun.
+app_title = config.get("app_title") or f"{user['name']}'s AI Tutor"
+config_model_id = config.get("model_id")
 st.set_page_config(page_title=app_title, layout="wide")
 
 # --- UI ---
@@ -232,73 +573,64 @@ st.title(app_title)
 # Sidebar (History + model selector)
 with st.sidebar:
     # model selector: show only allowed models for this student
-    allowed_models = database.get_allowed_models_for_student(user['id'])
+    allowed_models = cached_allowed_models(user['id'])
+    models_by_id = {m['id']: m for m in allowed_models}
     if allowed_models:
-        sel = config.get('model_id')
+        sel = config_model_id
         options = {m['id']: m['name'] for m in allowed_models}
         idx = 0
         if sel in options:
             idx = list(options.keys()).index(sel)
         choice = st.selectbox("Model", options.keys(), format_func=lambda i: options[i], index=idx)
         if choice != sel:
-            config['model_id'] = choice
+            config['model_id'] = config_model_id = choice
             save_config(username, config)
     else:
         st.write("No models assigned by teacher.")
     
     st.header("Chat History")
     if st.button("New Chat", use_container_width=True):
+        _flush_pending_session(username)
         st.session_state.messages = []
         st.session_state.session_id = str(uuid.uuid4())
         st.rerun()
         
-    # Load History
-    import glob
-    history_dir = os.path.join(get_user_dir(username), "history")
-    if os.path.exists(history_dir):
-        files = glob.glob(os.path.join(history_dir, "*.json"))
-        files.sort(key=os.path.getmtime, reverse=True)
-        for fpath in files:
-            fname = os.path.basename(fpath)
-            sid = fname.replace(".json", "")
-            try:
-                with open(fpath, "r", encoding="utf-8") as f:
-                    meta = json.load(f)
-                    title = meta.get("title", "Untitled Chat")
-            except:
-                title = "Corrupted"
-            
-            # Using columns for Chat Title and Delete Button
-            col1, col2 = st.columns([4, 1])
-            with col1:
-                # Truncate title for button
-                btn_title = title if len(title) < 20 else title[:17] + "..."
-                if st.button(f"{btn_title}", key=f"open_{sid}", use_container_width=True, help=title):
-                    msgs, _ = load_session(username, sid)
-                    st.session_state.messages = msgs
-                    st.session_state.session_id = sid
-                    st.rerun()
-            with col2:
-                if st.button("Delete", key=f"del_{sid}"):
-                    delete_session(username, sid)
-                    if st.session_state.get('session_id') == sid:
-                        st.session_state.messages = []
-                        st.session_state.session_id = str(uuid.uuid4())
-                    st.rerun()
+    # Load History: titles come from the single history/.index sidecar (HISTORY_INDEX_NAME)
+    index_mtime = _history_index_mtime(username)
+    if index_mtime is None:
+        # Missing (new user, or app.py changed a session): rebuild it first so
+        # the cache below is keyed on the fresh file.
+        load_history_index(username)
+        index_mtime = _history_index_mtime(username)
+    sessions = sorted_history(username, index_mtime)
+    if sessions:
+        # One picker and one delete button, however many chats there are
+        titles = {sid: meta.get("title", "Untitled Chat") for sid, meta in sessions}
+        session_ids = list(titles)
+        current_sid = st.session_state.get("session_id")
+        picked = st.selectbox(
+            "Past chats", session_ids,
+            index=session_ids.index(current_sid) if current_sid in titles else None,
+            format_func=lambda s: titles[s], placeholder="Open a past chat..."
+        )
+        if picked and picked != current_sid:
+            _flush_pending_session(username)
+            msgs, _ = load_session(username, picked)
+            st.session_state.messages = msgs
+            st.session_state.session_id = picked
+            st.rerun()
+        if current_sid in titles and st.button("Delete this chat", use_container_width=True):
+            delete_session(username, current_sid)
+            st.session_state._pending_save = False
+            st.session_state.messages = []
+            st.session_state.session_id = str(uuid.uuid4())
+            st.rerun()
 
 # Determine active model (needed across tabs)
-current_model = None
-if config.get('model_id'):
-    for m in allowed_models:
-        if m['id'] == config['model_id']:
-            current_model = m
-            break
-if not current_model and allowed_models:
-    current_model = allowed_models[0]
+current_model = models_by_id.get(config_model_id) or (allowed_models[0] if allowed_models else None)
 
 # RAG knowledge base toggle (sidebar — visible in all tabs)
-docs = database.get_documents()
-indexed_docs = [d for d in docs if d['index_status'] == 'indexed']
+indexed_docs = cached_indexed_docs()
 if indexed_docs and current_model:
     with st.sidebar:
         use_rag = st.toggle("Use Knowledge Base", value=False, key="use_rag")
@@ -323,9 +655,9 @@ with tab_chat:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
             if "image_path" in msg:
-                img_path = get_image_path(username, msg["image_path"])
-                if os.path.exists(img_path):
-                    st.image(img_path, width=300)
+                img = load_image_bytes(username, msg["image_path"])
+                if img is not None:
+                    st.image(img, width=300)
 
     uploaded_file = st.file_uploader(
         "Attach image (optional)", type=["jpg", "png", "jpeg"],
@@ -341,8 +673,12 @@ with tab_chat:
                 st.image(uploaded_file, width=300)
 
         msg_data = {"role": "user", "content": user_input}
+        img_b64 = None
         if uploaded_file:
-            msg_data["image_path"] = save_image(username, uploaded_file.getvalue())
+            upload_bytes = uploaded_file.getvalue()
+            msg_data["image_path"] = save_image(username, upload_bytes)
+            _remember_image(msg_data["image_path"], upload_bytes)
+            img_b64 = base64.b64encode(upload_bytes).decode("ascii")
         st.session_state.messages.append(msg_data)
 
         response_text = ""
@@ -354,45 +690,50 @@ with tab_chat:
                 if sel_doc and sel_doc.get('index_path'):
                     rag_inject = rag_utils.retrieve_context(sel_doc['index_path'], user_input)
 
-            # Build message list
-            chat_messages = [
-                {"role": m["role"], "content": m["content"]}
-                for m in st.session_state.messages
-            ]
-            # Prepend RAG as a system context block if available
-            if rag_inject:
-                chat_messages[-1]["content"] = (
-                    f"[Relevant document context:]\n{rag_inject}\n\n"
-                    f"[Student question:] {user_input}"
-                )
-            response_text = call_model_api(current_model, chat_messages)
+            # Build message list from the most recent turns only. Text turns
+            # ({role, content} only) are passed through without copying.
+            window = st.session_state.messages[-CHAT_CONTEXT_WINDOW:]
+            chat_messages = [m if len(m) == 2 else {"role": m["role"], "content": m["content"]}
+                             for m in window[:-1]]
+            # The question goes last, wrapped with the RAG context if there is any
+            chat_messages.append({"role": "user", "content": (
+                f"[Relevant document context:]\n{rag_inject}\n\n[Student question:] {user_input}"
+                if rag_inject else user_input
+            )})
+            # Tokens are drawn as they arrive; write_stream returns the full text.
+            with st.chat_message("assistant"):
+                response_text = st.write_stream(stream_model_api(current_model, chat_messages, img_b64))
         else:
             response_text = "[No model assigned. Ask your teacher to grant model access.]"
-
-        with st.chat_message("assistant"):
-            st.markdown(response_text)
+            with st.chat_message("assistant"):
+                st.markdown(response_text)
         st.session_state.messages.append({"role": "assistant", "content": response_text})
-        save_session(username, st.session_state.session_id, st.session_state.messages)
+        append_session(username, st.session_state.session_id, st.session_state.messages)
+        st.session_state._pending_save = True
         st.session_state.last_qa = (user_input, response_text)
-        st.rerun()
+        # This run has already drawn the turn; only a brand-new chat needs a
+        # full rerun so it shows up under Chat History.
+        if len(st.session_state.messages) == 2:
+            st.rerun()
 
     if "last_qa" in st.session_state and current_model:
         q, a = st.session_state.last_qa
         if st.button("Add Last Q&A to Notebook"):
-            with st.spinner("Summarizing..."):
-                summary = call_model_api_single(
-                    current_model,
-                    f"Summarize the key concept or mistake in 1-2 sentences.\nQ: {q}\nA: {a}"
-                )
-                add_to_notebook(username, q, a, summary)
-            st.success("Added to Notebook!")
+            # Save now; the summary is generated in the background and filled
+            # in by _collect_pending_summaries on a later rerun.
+            entry_id = add_to_notebook(username, q, a)
+            st.session_state.setdefault("pending_summaries", {})[entry_id] = background_executor().submit(
+                call_model_api_single, current_model,
+                f"Summarize the key concept or mistake in 1-2 sentences.\nQ: {q}\nA: {a}"
+            )
+            st.success("Added to Notebook! The summary will follow shortly.")
             del st.session_state.last_qa
 
 with tab_practice:
     st.header("Practice Questions")
 
     # Section 1: Teacher-assigned questions
-    assigned_qs = database.get_questions_for_student(user['id'])
+    assigned_qs = database.get_questions_for_student(user['id'], include_options=False)
     if assigned_qs:
         st.subheader("Assigned by Teacher")
         for q in assigned_qs:
@@ -404,12 +745,10 @@ with tab_practice:
     st.subheader("Generate from My Notebook")
     st.write("Select notebook entries to generate targeted practice questions.")
 
-    notebook = load_notebook(username)
+    notebook, options = sorted_notebook(username)
     if not notebook:
         st.info("Your notebook is empty. Add entries from Chat first.")
     else:
-        notebook.sort(key=lambda x: x['timestamp'], reverse=True)
-        options = {e['id']: f"{e['title']} ({e['timestamp'][:10]})" for e in notebook}
         selected_ids = st.multiselect(
             "Select entries:", list(options.keys()),
             format_func=lambda x: options[x]
@@ -452,11 +791,10 @@ with tab_practice:
 with tab_notebook:
     st.header("Your Notebook")
 
-    notebook = load_notebook(username)
+    notebook, _ = sorted_notebook(username)
     if not notebook:
         st.info("No entries yet.")
     else:
-        notebook.sort(key=lambda x: x['timestamp'], reverse=True)
         for entry in notebook:
             with st.expander(f"{entry['title']} - {entry['timestamp'][:16]}"):
                 new_title = st.text_input("Title", value=entry['title'], key=f"title_{entry['id']}")
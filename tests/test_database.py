@@ -12,6 +12,9 @@ from database import (
     delete_model,
     create_user,
     set_student_model_access,
+    set_student_model_access_bulk,
+    save_generated_questions,
+    get_questions_for_document,
     get_allowed_models_for_student,
 )
 
@@ -23,6 +26,7 @@ def temp_db(monkeypatch):
     monkeypatch.setattr('database.DB_FILE', path)
     init_db()
     yield
+    database.close_db()
     os.remove(path)
 
 
@@ -55,3 +59,248 @@ def test_student_access():
     allowed = get_allowed_models_for_student(sid)
     assert len(allowed) == 1
     assert allowed[0]['name'] == 'mx' or allowed[0]['name'] == 'm1'
+
+
+def test_init_db_is_versioned():
+    conn = sqlite3.connect(database.DB_FILE)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == database.SCHEMA_VERSION
+    conn.close()
+    # a second call on a current schema is a no-op
+    init_db()
+    conn = sqlite3.connect(database.DB_FILE)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 3
+    conn.close()
+
+
+def test_hot_queries_use_indexes():
+    conn = sqlite3.connect(database.DB_FILE)
+    def plan(sql, *params):
+        return " ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+    assert "idx_users_role" in plan("SELECT * FROM users WHERE role=? ORDER BY username", "student")
+    assert "idx_sma_model" in plan("SELECT user_id FROM student_model_access WHERE model_id=?", 1)
+    assert "idx_class_students_student" in plan(
+        "SELECT cma.model_id FROM class_model_access cma "
+        "JOIN class_students cs ON cma.class_id=cs.class_id WHERE cs.student_id=?", 1)
+    assert "uq_users_lower_username" in plan("SELECT id FROM users WHERE LOWER(username)=?", "stu")
+    login = plan(database._SQL_VERIFY_USER, "stu", "stu")
+    assert "uq_users_lower_username" in login and "uq_users_lower_email" in login
+    assert "idx_gq_assigned" in plan(
+        "SELECT * FROM generated_questions WHERE assigned_to=? ORDER BY created_at DESC", 1)
+    assert "MERGE (UNION ALL)" in plan(database._SQL_STUDENT_QUESTIONS.format(cols="gq.*"), 1, 20, 0)
+    assert "idx_gq_doc" in plan("SELECT * FROM generated_questions WHERE document_id=?", 1)
+    assert "idx_dep_status" in plan("SELECT port FROM deployments WHERE status='running'")
+    assert "idx_classes_teacher" in plan("SELECT * FROM classes WHERE teacher_id=? ORDER BY name", 1)
+    assert "idx_documents_folder" in plan("SELECT * FROM documents WHERE folder_id=? ORDER BY name", 1)
+    assert "idx_mrl_doc" in plan("DELETE FROM model_rag_links WHERE document_id=?", 1)
+    assert "idx_chat_logs_user" in plan(
+        "SELECT * FROM chat_logs WHERE user_id=? ORDER BY created_at DESC LIMIT 5", 1)
+    conn.close()
+
+
+def test_cleanup_zombies_only_stops_dead_processes():
+    conn = sqlite3.connect(database.DB_FILE)
+    conn.execute("INSERT INTO deployments (user_id, port, pid, status) VALUES (1, 8501, ?, 'running')",
+                 (os.getpid(),))
+    conn.execute("INSERT INTO deployments (user_id, port, pid, status) VALUES (2, 8502, NULL, 'running')")
+    conn.commit()
+    database.cleanup_zombies()
+    status = dict(conn.execute("SELECT user_id, status FROM deployments"))
+    conn.close()
+    assert status == {1: 'running', 2: 'stopped'}
+
+
+def test_student_access_bulk():
+    create_model('m1', 'test-model', 'http://example.com')
+    m = get_models()[0]
+    create_user('stu1', 'pw', 'student', 'Stu One')
+    create_user('stu2', 'pw', 'student', 'Stu Two')
+    conn = sqlite3.connect(database.DB_FILE)
+    ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE username IN ('stu1','stu2') ORDER BY username")]
+    conn.close()
+    set_student_model_access_bulk([(ids[0], m['id'], True, 'be brief'), (ids[1], m['id'], False, None)])
+    assert [x['name'] for x in get_allowed_models_for_student(ids[0])] == ['m1']
+    assert get_allowed_models_for_student(ids[1]) == []
+    # upsert flips an existing row
+    set_student_model_access_bulk([(ids[1], m['id'], True, None)])
+    assert len(get_allowed_models_for_student(ids[1])) == 1
+
+
+def test_save_generated_questions_bulk():
+    save_generated_questions([
+        (7, 'Multiple Choice', 'Q1', ['a', 'b'], 'a', None),
+        (7, 'Short Answer', 'Q2', None, None, 3),
+    ])
+    qs = sorted(get_questions_for_document(7), key=lambda q: q['question'])
+    assert [q['question'] for q in qs] == ['Q1', 'Q2']
+    assert qs[0]['options'] == ['a', 'b']
+    assert qs[1]['assigned_to'] == 3
+    save_generated_questions([])  # no-op
+
+
+def test_create_user_rejects_case_insensitive_duplicates():
+    assert create_user('Alice', 'pw', 'student', 'Alice', email='a@x.com') == (True, 'OK')
+    assert create_user('alice', 'pw', 'student', 'Alice') == (False, 'Username already taken')
+    assert create_user('bob', 'pw', 'student', 'Bob', email='A@X.com') == (False, 'Email already registered')
+
+
+def test_create_user_duplicate_skips_password_hash(monkeypatch):
+    assert create_user('Alice', 'pw', 'student', 'Alice')[0]
+    calls = []
+    monkeypatch.setattr('database.hash_password', lambda pw: calls.append(pw) or 'x')
+    assert create_user('ALICE', 'pw', 'student', 'Alice') == (False, 'Username already taken')
+    assert calls == []
+
+
+def test_delete_user_removes_memberships():
+    create_user('stu', 'pw', 'student', 'Stu')
+    conn = sqlite3.connect(database.DB_FILE)
+    sid = conn.execute("SELECT id FROM users WHERE username='stu'").fetchone()[0]
+    conn.close()
+    cid = database.create_class('c1', 2)
+    database.add_student_to_class(cid, sid)
+    set_student_model_access(sid, 1, True)
+    database.log_message(sid, 's', None, 'user', 'hi')
+    database.delete_user(sid)
+    assert database.get_user_by_id(sid) is None
+    assert database.get_students_in_class(cid) == []
+    conn = sqlite3.connect(database.DB_FILE)
+    for tbl in ('student_model_access', 'chat_logs'):
+        assert conn.execute(f"SELECT COUNT(*) FROM {tbl} WHERE user_id=?", (sid,)).fetchone()[0] == 0
+    conn.close()
+
+
+def test_reserved_or_traversing_usernames_leave_files_alone(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    (data / "documents").mkdir(parents=True)
+    (tmp_path / "x").mkdir()
+    monkeypatch.setattr('database.USER_DATA_DIR', str(data))
+    monkeypatch.setattr('database.DELETED_DIR', str(data / ".deleted"))
+    for name in ('documents', 'Documents', '../x', '..', 'a/b'):
+        assert create_user(name, 'pw', 'student', 'X') == (False, 'Invalid username')
+    # rows created before the check existed must not move shared folders either
+    for name in ('documents', '../x'):
+        database._archive_user_dir(name)
+    assert (data / "documents").is_dir() and (tmp_path / "x").is_dir()
+    assert not (data / ".deleted").exists()
+    (data / "stu").mkdir()
+    database._archive_user_dir('stu')
+    assert not (data / "stu").exists()
+    assert len(os.listdir(data / ".deleted")) == 1
+
+
+def test_questions_for_student_paging():
+    save_generated_questions([(1, 'MC', f'Q{i}', None, None, None) for i in range(5)])
+    assert database.count_questions_for_student(3) == 5
+    page = database.get_questions_for_student(3, limit=2, offset=4)
+    assert len(page) == 1
+    assert len(database.get_questions_for_student(3)) == 5
+
+
+def test_import_students_from_csv():
+    csv_text = (
+        "username,email,name,password\n"
+        "amy,amy@x.com,Amy,pw\n"
+        "Student01,,Dup,pw\n"
+        "AMY,other@x.com,Amy Again,pw\n"
+        "ben,AMY@x.com,Ben,pw\n"
+        "short,row\n"
+        "cal,,,pw\n"
+    )
+    ok, errors = database.import_students_from_csv(csv_text)
+    assert ok == 2
+    assert errors == [
+        "Row 3 (Student01): Username already taken",
+        "Row 4 (AMY): Username already taken",
+        "Row 5 (ben): Email already registered",
+        "Row 6: expected 4 columns, got 2: ['short', 'row']",
+    ]
+    assert database.verify_user('cal', 'pw')['name'] == 'cal'
+
+
+def test_delete_folder_keeps_children():
+    parent = database.create_folder('parent')
+    child = database.create_folder('child', parent_id=parent)
+    doc = database.save_document('d', 'p', 'pdf', folder_id=parent)
+    database.delete_folder(parent)
+    assert [f['id'] for f in database.get_folders()] == [child]
+    assert database.get_document(doc)['folder_id'] is None
+
+
+def test_legacy_sha256_password_is_upgraded_on_login():
+    create_user('old', 'pw', 'student', 'Old')
+    conn = sqlite3.connect(database.DB_FILE)
+    conn.execute("UPDATE users SET password=? WHERE username='old'", (database._sha256_hex('pw'),))
+    conn.commit()
+    conn.close()
+    assert database.verify_user('old', 'wrong') is None
+    user = database.verify_user('old', 'pw')
+    assert user is not None
+    if database.HAS_BCRYPT or database.HAS_SCRYPT:
+        assert not database._needs_rehash(user['password'])
+        assert database.verify_user('old', 'pw')['id'] == user['id']
+
+
+def test_cached_lookups_see_writes_and_return_copies():
+    u = database.get_user_by_id(3)
+    u['name'] = 'mutated'
+    assert database.get_user_by_id(3)['name'] == 'Student One'
+    database.update_user_profile(3, new_name='Renamed')
+    assert database.get_user_by_id(3)['name'] == 'Renamed'
+    create_model('m1', 'test-model', 'http://example.com')
+    assert [m['name'] for m in get_models()] == ['m1']
+    update_model(get_models()[0]['id'], name='m2')
+    assert [m['name'] for m in get_models()] == ['m2']
+
+
+def test_allowed_models_carry_override_prompt():
+    create_model('m1', 'test-model', 'http://example.com')
+    create_model('m2', 'test-model', 'http://example.com')
+    m1, m2 = [m['id'] for m in get_models()]
+    cid = database.create_class('c1', 2)
+    database.add_student_to_class(cid, 3)
+    database.set_class_model_access(cid, m1, True, 'class prompt')
+    database.set_class_model_access(cid, m2, True, 'class prompt')
+    set_student_model_access(3, m1, True, 'student prompt')
+    set_student_model_access(3, m2, True, None)
+    allowed = {m['name']: m['override_prompt'] for m in get_allowed_models_for_student(3)}
+    assert allowed == {'m1': 'student prompt', 'm2': 'class prompt'}
+
+
+def test_user_updates_change_only_given_fields():
+    ok, _ = database.update_user_profile(3, new_name='New', new_email='s@x.com')
+    assert ok
+    u = database.get_user_by_id(3)
+    assert (u['username'], u['name'], u['email']) == ('student01', 'New', 's@x.com')
+    database.update_user_profile(3, new_email='')
+    assert database.get_user_by_id(3)['email'] is None
+    ok, _ = database.admin_update_user(3, 'Admin Set', 'stu3', role='teacher')
+    u = database.get_user_by_id(3)
+    assert ok and (u['username'], u['name'], u['role']) == ('stu3', 'Admin Set', 'teacher')
+    assert database.update_user_profile(3, new_username='Teacher')[0] is False
+
+
+def test_get_indexed_documents_filters_and_sorts():
+    b = database.save_document('b', 'p', 'pdf')
+    a = database.save_document('a', 'p', 'pdf')
+    database.save_document('c', 'p', 'pdf')
+    database.update_document_index(b, 'idx_b.json')
+    database.update_document_index(a, 'idx_a.json')
+    assert [(d['name'], d['index_path']) for d in database.get_indexed_documents()] == [
+        ('a', 'idx_a.json'), ('b', 'idx_b.json')]
+
+
+def test_create_user_without_case_insensitive_index():
+    # a legacy database whose usernames differ only by case can't get
+    # uq_users_lower_username; duplicates must still be rejected
+    conn = sqlite3.connect(database.DB_FILE)
+    conn.execute("DROP INDEX uq_users_lower_username")
+    conn.executemany("INSERT INTO users (username, password, role, name) VALUES (?, 'x', 'student', ?)",
+                     [('Bob', 'Bob'), ('bob', 'bob')])
+    conn.commit()
+    conn.close()
+    init_db()
+    assert create_user('Carol', 'pw', 'student', 'Carol') == (True, 'OK')
+    assert create_user('carol', 'pw', 'student', 'Carol') == (False, 'Username already taken')
+    assert create_user('STUDENT01', 'pw', 'student', 'S') == (False, 'Username already taken')
+    ok, msg = create_user('dan', 'pw', 'student', None)
+    assert not ok and msg.startswith('NOT NULL')
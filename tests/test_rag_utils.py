@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import rag_utils
+
+
+@pytest.fixture
+def txt_doc(tmp_path):
+    path = tmp_path / "doc.txt"
+    # three 2000-char "pages"
+    pages = [
+        "photosynthesis converts light energy in the chloroplast ",
+        "the mitochondria is the powerhouse of the cell ",
+        "cell division happens by mitosis and meiosis ",
+    ]
+    path.write_text("".join((p * 100)[:2000] for p in pages), encoding="utf-8")
+    return str(path)
+
+
+def test_retrieve_ranks_matching_pages(txt_doc):
+    index = rag_utils.build_page_index(txt_doc, "txt")
+    assert index["page_count"] == 3
+    assert index["postings"]["cell"][::2] == [1, 2]
+    assert len(index["pages"][0]["text"]) == rag_utils.MAX_CHARS_PER_PAGE_DEFAULT
+    ctx = rag_utils.retrieve_context(index, "What is the mitochondria?", top_n=1)
+    assert ctx.startswith("[Page 2]")
+    # no overlapping tokens: fall back to the first pages
+    assert rag_utils.retrieve_context(index, "zzz", top_n=1).startswith("[Page 1]")
+
+
+def test_retrieve_reads_saved_index(txt_doc, tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_utils, "DOCS_DIR", str(tmp_path / "docs"))
+    index = rag_utils.build_page_index(txt_doc, "txt")
+    path = rag_utils.save_index(7, index)
+    header = rag_utils.load_index(path, with_text=False)
+    assert all("text" not in p for p in header["pages"])
+    assert rag_utils.load_index(path)["pages"] == [
+        dict(p, offset=h["offset"], length=h["length"]) for p, h in zip(index["pages"], header["pages"])]
+    assert "[Page 3]" in rag_utils.retrieve_context(path, "meiosis")
+    # an unchanged index is not parsed again
+    read_json = rag_utils._read_json
+    monkeypatch.setattr(rag_utils, "_read_json", None)
+    assert "[Page 3]" in rag_utils.retrieve_context(path, "meiosis")
+    monkeypatch.setattr(rag_utils, "_read_json", read_json)
+    # indexes saved as a single JSON file still load
+    legacy = str(tmp_path / "legacy.json")
+    rag_utils._write_json(legacy, index)
+    assert "[Page 3]" in rag_utils.retrieve_context(legacy, "meiosis")
+    rag_utils.delete_index(path)
+    assert os.listdir(tmp_path / "docs") == []
+
+
+def test_tokenize_is_unicode_aware():
+    assert rag_utils._tokenize("Café_au 中國 Straße 42") == ["café", "au", "中", "國", "strasse", "42"]
+
+
+def test_unchanged_file_reuses_saved_index(txt_doc, tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_utils, "DOCS_DIR", str(tmp_path / "docs"))
+    rag_utils.save_index(1, rag_utils.build_or_load_page_index(txt_doc, "txt"))
+
+    def no_extract(*args):
+        raise AssertionError("re-extracted an unchanged file")
+    monkeypatch.setattr(rag_utils, "extract_pages", no_extract)
+    index = rag_utils.build_or_load_page_index(txt_doc, "txt")
+    assert index["page_count"] == 3
+
+
+def test_retrieve_context_many_matches_single_calls(txt_doc):
+    index = rag_utils.build_page_index(txt_doc, "txt")
+    assert rag_utils.retrieve_context_many([index, index], "mitosis", top_n=1) == \
+        [rag_utils.retrieve_context(index, "mitosis", top_n=1)] * 2